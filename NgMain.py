@@ -1,43 +1,39 @@
 #!/usr/bin/env python3.9
-from ngremote import NgRemote
 from ngbackup import NgBackup
-import logging
-from pathlib import Path
-import os
+import argparse
 import sys
-import psutil
 
-working_directory = Path(os.getcwd())
-pidfile = working_directory / 'ngbackup.pid'
-
-def is_running() -> bool:
-    if pidfile.exists():
-        f = open(pidfile, 'r')        
-        pid = int(f.readline().strip('\n'))
-        f.close()
-
-        try:
-            p = psutil.Process(pid)
-        except Exception:
-            # We have encountered a stale pidfile. Probably the script was interrupted
-            backup.logger.log(logging.INFO, "Process with ID: %d is not running. Review log files from previous run", pid)
-            os.unlink(pidfile)      
-            return False
-        else:
-            return True
-    else:
-        return False
+commands = ['run', 'scrub', 'restore', 'filter-report']
+parser = argparse.ArgumentParser(description="Rsync incremental backup", usage="%(prog)s [-h] [command] [tasks ...] [options]")
+parser.add_argument('command', nargs='?', default='run', help="run: backup tasks that are due (default), scrub: verify increments, restore: restore an increment of one task, filter-report: show what the filter rules exclude")
+parser.add_argument('tasks', nargs='*', help="Limit the command to these tasks")
+parser.add_argument('--verify', action='store_true', help="scrub: re-hash inodes already in the hash cache")
+parser.add_argument('--increment', help="restore: increment to restore, for example hourly/20210101_000000")
+parser.add_argument('--target', help="restore: directory to restore to")
+args = parser.parse_args()
+if args.command not in commands:
+    # "NgMain.py Data Photos" runs those tasks
+    args.tasks.insert(0, args.command)
+    args.command = 'run'
+if args.command == 'restore' and (len(args.tasks) != 1 or not args.increment or not args.target):
+    parser.error("restore requires exactly one task, --increment and --target")
 
+# Tasks are locked individually (see NgLock). Tasks still in progress from an
+# earlier invocation are skipped, everything else is run
 backup = NgBackup()
+unknown = [name for name in args.tasks if name.lower() not in backup.config.rsync_tasks]
+if unknown:
+    parser.error(f"unknown command or task: {', '.join(unknown)}. Commands: {', '.join(commands)}")
 
-if is_running():
-    backup.logger.log(logging.INFO, "Only one instance can be run at one time. Exiting")
-    sys.exit()
+exit_code = 0
+if args.command == 'scrub':
+    if not backup.scrub(args.tasks, args.verify):
+        exit_code = 1
+elif args.command == 'restore':
+    if not backup.restore(args.tasks[0], args.increment, args.target):
+        exit_code = 1
+elif args.command == 'filter-report':
+    backup.filter_report(args.tasks)
 else:
-    str_pid = str(os.getpid())
-    f = open(pidfile, 'w')
-    f.write(str_pid)
-    f.close()
-
-backup.run()
-os.unlink(pidfile)
\ No newline at end of file
+    backup.run(args.tasks)
+sys.exit(exit_code)
@@ -1,5 +1,13 @@
 import time
 from ngconfig import NgConfig
+from ngfilter import NgFilter
+from nglock import NgLock
+from ngnotify import NgNotifier
+from ngprobe import NgProbe
+from ngscheduler import NgScheduler
+from ngscrub import NgScrub
+from ngtask import NgTask
+from interval import Interval
 from pathlib import Path
 import logging
 import logging.handlers
@@ -10,11 +18,17 @@ class NgBackup:
 
     logger: logging.Logger
     config: NgConfig
+    scheduler: NgScheduler
+    probe: NgProbe
+    notifier: NgNotifier = None
     
     def __init__(self) -> None:        
         self.setup_folders()
         self.setup_logging()
         self.config = NgConfig()
+        self.scheduler = NgScheduler(self.config.max_threads, self.config.run_window, self.config.task_priorities)
+        self.probe = NgProbe(self.config.connect_timeout, self.config.probe_cache_ttl)
+        self.setup_notifier()
 
     def setup_logging(self):
         self.logger = logging.getLogger('NgBackup')
@@ -41,6 +55,26 @@ class NgBackup:
 
         self.logger.log(logging.INFO, "Logging Initialized")        
 
+    def setup_notifier(self):
+        smtp = self.config.smtp
+        if not smtp.get("host"):
+            return
+        self.notifier = NgNotifier(
+            smtp["host"],
+            int(smtp.get("port", 25)),
+            smtp.get("sender", "ngbackup@localhost"),
+            smtp.get("user"),
+            smtp.get("password"),
+            smtp.get("starttls", "no").lower() in ("yes", "true", "1"),
+            float(smtp.get("batch_delay", 60)))
+
+    def notify(self, task: NgTask, interval: Interval, success: bool, message: str, skipped: bool = False):
+        if not self.notifier:
+            return
+        for email, intervals in task.notifications.items():
+            if interval.name in intervals:
+                self.notifier.enqueue(email, task.name, interval.name, success, message, skipped)
+
     def setup_folders(self):
         working_directory = Path(os.getcwd())
         
@@ -52,24 +86,223 @@ class NgBackup:
         if not control_directory.exists():
             control_directory.mkdir()
     
-    def run(self):
+    def run(self, task_names: list[str] = None):
+        if task_names:
+            task_names = [name.lower() for name in task_names]
+        work: list[tuple[NgTask, list[Interval]]] = []
         for taskname in self.config.rsync_tasks.keys():
+            if task_names and taskname not in task_names:
+                continue
             task = self.config.rsync_tasks.get(taskname)
-            if task.src_remote or task.dest_remote:
-                task.connect_remote()
-                if not task.remote_alive():
+            if NgLock(task).is_locked():
+                self.logger.log(logging.INFO, "Task: %s is still in progress. Skipping", task.name)
+                continue
+            due_intervals = self.get_due_intervals(task)
+            if due_intervals:
+                work.append((task, due_intervals))
+        work = self.preflight(work)
+        if self.notifier:
+            self.notifier.start()
+        try:
+            self.scheduler.dispatch(work, self.run_task, self.defer_task)
+        finally:
+            if self.notifier:
+                self.notifier.stop()
+
+    def preflight(self, work: list[tuple[NgTask, list[Interval]]]) -> list[tuple[NgTask, list[Interval]]]:
+        """Probes all remote hosts concurrently and drops the tasks none of whose destinations is reachable"""
+        hosts = set()
+        for task, intervals in work:
+            for destination in [task] + task.fanout:
+                if destination.remote_host:
+                    hosts.add((destination.remote_host, destination.ssh_port))
+        status = self.probe.probe_all(hosts)
+        reachable_work: list[tuple[NgTask, list[Interval]]] = []
+        for task, intervals in work:
+            reachable = [destination for destination in [task] + task.fanout if not destination.remote_host or status.get((destination.remote_host, destination.ssh_port))]
+            if not reachable:
+                self.logger.log(logging.WARNING, "Skipping Task: %s. Host %s is not reachable", task.name, task.remote_host)
+                for interval in intervals:
+                    self.notify(task, interval, False, f"Host {task.remote_host} is not reachable")
+                continue
+            reachable_work.append((task, intervals))
+        return reachable_work
+
+    def defer_task(self, task: NgTask, intervals: list[Interval], reason: str):
+        for interval in intervals:
+            self.notify(task, interval, False, f"Deferred to the next run. {reason}", skipped=True)
+
+    def get_due_intervals(self, task: NgTask) -> list[Interval]:
+        due_intervals: list[Interval] = []
+        for interval_name in self.config.intervals.keys():
+            interval = self.config.intervals.get(interval_name)
+            last_run = task.get_last_run(interval)
+            current_time = int(time.time())
+            self.logger.log(logging.INFO, "Task: %s, Duration: %d, Last Run: %d Diff: %d", task.name, interval.duration, last_run, current_time - last_run)
+            if (current_time - last_run) > interval.duration:
+                due_intervals.append(interval)
+            else:
+                self.logger.log(logging.INFO, "Skipping %s backup", interval.name)
+        return due_intervals
+
+    def run_task(self, task: NgTask, intervals: list[Interval]):
+        lock = NgLock(task)
+        if not lock.acquire():
+            self.logger.log(logging.INFO, "Task: %s is still in progress. Skipping", task.name)
+            return
+        try:
+            self.__run_locked_task(task, intervals)
+        finally:
+            lock.release()
+
+    def __connect_destination(self, destination: NgTask, intervals: list[Interval]) -> bool:
+        """Connects a remote destination (or source). Reports the intervals as failed if it is not reachable"""
+        if not destination.remote_host:
+            return True
+        # Tasks may start long after the pre-flight stage. Re-probe if the result has expired
+        message = None
+        if not self.probe.is_reachable(destination.remote_host, destination.ssh_port):
+            message = f"Host {destination.remote_host} is not reachable"
+        else:
+            destination.connect_remote()
+            if not destination.remote_alive():
+                destination.close_remote()
+                message = f"Could not connect to {destination.remote_host}"
+        if message:
+            self.logger.log(logging.WARNING, "Skipping destination %s of Task: %s. %s", destination.dest_uri, destination.name, message)
+            for interval in intervals:
+                self.notify(destination, interval, False, message)
+            return False
+        return True
+
+    def __run_locked_task(self, task: NgTask, intervals: list[Interval]):
+        # Each destination is probed on its own, an unreachable one does not hold back the others
+        destinations = [destination for destination in [task] + task.fanout if self.__connect_destination(destination, intervals)]
+        if destinations:
+            primary = destinations[0]
+            if primary is not task:
+                self.logger.log(logging.INFO, "Task: %s destination %s is not reachable. %s scans the source instead", task.name, task.dest_uri, primary.dest_uri)
+            for interval in intervals:
+                start_time = time.time()
+                status = primary.synchronize(interval, destinations[1:])
+                duration = time.time() - start_time
+                if status.get(task.name):
+                    self.scheduler.record(task, interval, duration, task.transferred_bytes)
+                for destination in destinations:
+                    if status.get(destination.name):
+                        self.notify(destination, interval, True, f"Duration: {duration:.0f}s Transferred: {destination.transferred_bytes} bytes")
+                    else:
+                        self.notify(destination, interval, False, f"Backup failed. See {destination.name} logs")
+            for destination in destinations:
+                if destination.remote_host:
+                    destination.close_remote()
+        self.replicate(task)
+
+    def replicate(self, task: NgTask):
+        """Copies the increments not yet replicated to each replica tier of the task"""
+        for replica in self.config.replicas.get(task.name, []):
+            tier = replica.tier
+            if tier.dest_remote:
+                if not self.probe.is_reachable(tier.remote_host, tier.ssh_port):
+                    self.logger.log(logging.WARNING, "Replica %s of Task: %s is not reachable. Will resume on the next run", tier.dest_uri, task.name)
+                    continue
+                tier.connect_remote()
+                if not tier.remote_alive():
                     continue
-            for interval_name in self.config.intervals.keys():
-                interval = self.config.intervals.get(interval_name)
-                last_run = task.get_last_run(interval)
-                current_time = int(time.time())
-                self.logger.log(logging.INFO, "Task: %s, Duration: %d, Last Run: %d Diff: %d", task.name, interval.duration, last_run, current_time - last_run)
-                if (current_time - last_run) > interval.duration:
-                    task.synchronize(interval)
-                else:
-                    self.logger.log(logging.INFO, "Skipping %s backup", interval.name)
-            if task.src_remote or task.dest_remote:
-                task.close_remote()
+            try:
+                replica.run()
+            finally:
+                if tier.dest_remote:
+                    tier.close_remote()
+
+    def scrub(self, task_names: list[str] = None, verify: bool = False) -> bool:
+        corrupt = False
+        if task_names:
+            task_names = [name.lower() for name in task_names]
+        for taskname in self.config.rsync_tasks.keys():
+            if task_names and taskname not in task_names:
+                continue
+            task = self.config.rsync_tasks.get(taskname)
+            lock = NgLock(task)
+            if not lock.acquire():
+                self.logger.log(logging.INFO, "Task: %s is in progress. Skipping scrub", task.name)
+                continue
+            try:
+                self.logger.log(logging.INFO, "Scrubbing increments of %s", task.name)
+                report = NgScrub(task, self.config.intervals, self.config.scrub_threads, verify).run()
+                if report:
+                    corrupt = True
+            finally:
+                lock.release()
+        return not corrupt
+
+    def restore(self, task_name: str, increment: str, target: str) -> bool:
+        """Restores an increment (interval/increment name) of a task to target, reassembling chunked files"""
+        task = self.config.rsync_tasks.get(task_name.lower())
+        if not task:
+            self.logger.log(logging.ERROR, "Task %s not found", task_name)
+            return False
+        if task.dest_remote:
+            self.logger.log(logging.ERROR, "Restore is only supported for local destinations")
+            return False
+        increment_path = Path(task.dest_path.as_posix()) / increment
+        if not increment_path.is_dir():
+            self.logger.log(logging.ERROR, "Increment %s not found", increment_path.as_posix())
+            return False
+        self.logger.log(logging.INFO, "Restoring %s to %s", increment_path.as_posix(), target)
+        return task.chunk_store.restore_increment(increment_path, Path(target))
+
+    def filter_report(self, task_names: list[str] = None, top: int = 20, max_increments: int = 3):
+        """Logs which excluded subtrees save the most files and bytes per task
+
+        Measured on the newest of the last max_increments increments that
+        still contains excluded files, i.e. one taken before the rules were
+        changed. Once the rules are in place new increments contain no
+        excluded files, so the result is kept in the control folder and
+        reported from there instead of walking older increments.
+        """
+        if task_names:
+            task_names = [name.lower() for name in task_names]
+        for taskname in self.config.rsync_tasks.keys():
+            if task_names and taskname not in task_names:
+                continue
+            task = self.config.rsync_tasks.get(taskname)
+            if not task.filter or not task.filter.rules:
+                self.logger.log(logging.INFO, "Task: %s has no filter rules", task.name)
+                continue
+            report_path = Path(os.getcwd()) / "control" / f"filter_report_{task.name}_{task.uid}.json"
+            report = None
+            if task.dest_remote:
+                self.logger.log(logging.WARNING, "Task: %s has a remote destination. Showing the last saved report", task.name)
+            else:
+                increments: list[Path] = []
+                for interval_name in self.config.intervals.keys():
+                    interval_path = Path(task.dest_path.as_posix()) / interval_name
+                    names = task.increment_index.list(interval_path) or []
+                    increments.extend(interval_path / name for name in names[-max_increments:] if not name.endswith("_temp"))
+                increments = [path for path in increments if path.is_dir()]
+                for increment_path in sorted(increments, key=lambda path: path.stat().st_mtime, reverse=True)[:max_increments]:
+                    savings = task.filter.measure(increment_path)
+                    if savings:
+                        report = {"increment": increment_path.as_posix(), "time": int(time.time()), "savings": savings}
+                        NgFilter.save_report(report_path, report)
+                        break
+            if not report:
+                report = NgFilter.load_report(report_path)
+            if not report:
+                self.logger.log(logging.INFO, "Task: %s no increment with excluded files found", task.name)
+                continue
+
+            self.logger.log(logging.INFO, "Task: %s filter savings measured on %s", task.name, report["increment"])
+            subtrees: list[tuple[str, str, int, int]] = []
+            for rule, paths in report["savings"].items():
+                files = sum(value[0] for value in paths.values())
+                size = sum(value[1] for value in paths.values())
+                self.logger.log(logging.INFO, "Rule: %-24s Paths: %6d Files: %8d Bytes: %14d", rule, len(paths), files, size)
+                subtrees.extend((rule, path, value[0], value[1]) for path, value in paths.items())
+            subtrees.sort(key=lambda item: (item[3], item[2]), reverse=True)
+            for rule, path, files, size in subtrees[:top]:
+                self.logger.log(logging.INFO, "Files: %8d Bytes: %14d %s (%s)", files, size, path, rule)
 
     @staticmethod
     def to_cygdrive(path: Path) -> str:
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3.9
+"""Benchmark harness for the remote code paths of NgTask and NgRemote.
+
+Starts a local SSH/SFTP stand-in server (paramiko) on loopback behind a
+proxy that injects round trip time and a bandwidth limit, writes a
+configuration with a task that backs up a generated source tree to the
+stand-in, and runs NgBackup.run a number of times. Reports wall time,
+round trips, channel opens and SFTP requests per phase.
+
+Example:
+    python ngbench.py --rtt 50 --bandwidth 1000 --files 200 --runs 3
+"""
+from ngbackup import NgBackup
+from ngtask import NgTask
+from pathlib import Path
+import argparse
+import logging
+import os
+import paramiko
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+class NgBenchStats:
+    """Counters shared by the proxy, the stand-in server and the phase timers"""
+    round_trips: int = 0
+    channel_opens: int = 0
+    sftp_requests: int = 0
+    bytes_up: int = 0
+    bytes_down: int = 0
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+
+    def add(self, name: str, value: int = 1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "round_trips": self.round_trips,
+                "channel_opens": self.channel_opens,
+                "sftp_requests": self.sftp_requests,
+                "bytes_up": self.bytes_up,
+                "bytes_down": self.bytes_down,
+            }
+
+# region Latency proxy
+class NgLatencyProxy:
+    """TCP proxy that delays every chunk by rtt / 2 and limits bandwidth per direction.
+
+    A round trip is counted every time the client sends data after having
+    received data from the server, which is how request/response exchanges
+    show up on the wire.
+    """
+    rtt: float
+    bandwidth: float
+    port: int
+
+    def __init__(self, upstream_port: int, stats: NgBenchStats, rtt_ms: float = 0, bandwidth_kbps: float = 0) -> None:
+        self.upstream_port = upstream_port
+        self.stats = stats
+        self.rtt = rtt_ms / 1000.0
+        self.bandwidth = bandwidth_kbps * 1024.0
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def __accept(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", self.upstream_port))
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            state = {"last_down": False}
+            threading.Thread(target=self.__pump, args=(client, upstream, True, state), daemon=True).start()
+            threading.Thread(target=self.__pump, args=(upstream, client, False, state), daemon=True).start()
+
+    def __pump(self, source: socket.socket, target: socket.socket, upstream: bool, state: dict):
+        # Chunks are released in order at max(arrival + rtt / 2, end of previous chunk) + size / bandwidth
+        release_time = 0.0
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                try:
+                    target.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                return
+            if upstream:
+                if state["last_down"]:
+                    self.stats.add("round_trips")
+                state["last_down"] = False
+                self.stats.add("bytes_up", len(data))
+            else:
+                state["last_down"] = True
+                self.stats.add("bytes_down", len(data))
+            release_time = max(time.time() + self.rtt / 2, release_time)
+            if self.bandwidth:
+                release_time = release_time + len(data) / self.bandwidth
+            delay = release_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                target.sendall(data)
+            except OSError:
+                return
+
+    def close(self):
+        self.server.close()
+# endregion
+
+# region SSH/SFTP stand-in
+class NgStandInSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+class NgStandInSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP server backed by the local file system. Counts every request"""
+    stats: NgBenchStats = None
+
+    def __count(self):
+        if self.stats:
+            self.stats.add("sftp_requests")
+
+    def list_folder(self, path):
+        self.__count()
+        try:
+            entries = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    def stat(self, path):
+        self.__count()
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    def lstat(self, path):
+        self.__count()
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    def open(self, path, flags, attr):
+        self.__count()
+        try:
+            fd = os.open(path, flags, 0o644)
+            if flags & os.O_WRONLY:
+                mode = "ab" if flags & os.O_APPEND else "wb"
+            elif flags & os.O_RDWR:
+                mode = "a+b" if flags & os.O_APPEND else "r+b"
+            else:
+                mode = "rb"
+            fobj = os.fdopen(fd, mode)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+        handle = NgStandInSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = fobj
+        handle.writefile = fobj
+        return handle
+
+    def remove(self, path):
+        self.__count()
+        try:
+            os.remove(path)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self.__count()
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        self.__count()
+        try:
+            os.mkdir(path)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        self.__count()
+        try:
+            os.rmdir(path)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+        return paramiko.SFTP_OK
+
+class NgStandInServer(paramiko.ServerInterface):
+    """Accepts any public key, runs exec requests with the local shell"""
+
+    def __init__(self, stats: NgBenchStats) -> None:
+        self.stats = stats
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            self.stats.add("channel_opens")
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.__exec, args=(channel, command.decode("utf8")), daemon=True).start()
+        return True
+
+    @staticmethod
+    def __exec(channel: paramiko.Channel, command: str):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def feed_stdin():
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                try:
+                    process.stdin.write(data)
+                    process.stdin.flush()
+                except OSError:
+                    break
+            process.stdin.close()
+
+        def drain_stderr():
+            for data in iter(lambda: process.stderr.read1(65536), b''):
+                channel.sendall_stderr(data)
+
+        threads = [threading.Thread(target=feed_stdin, daemon=True), threading.Thread(target=drain_stderr, daemon=True)]
+        for thread in threads:
+            thread.start()
+        for data in iter(lambda: process.stdout.read1(65536), b''):
+            channel.sendall(data)
+        threads[1].join()
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+class NgStandIn:
+    """Paramiko SSH server on loopback serving exec requests and the sftp subsystem"""
+    port: int
+
+    def __init__(self, stats: NgBenchStats) -> None:
+        self.stats = stats
+        self.host_key = paramiko.RSAKey.generate(2048)
+        NgStandInSFTPServer.stats = stats
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def __accept(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, NgStandInSFTPServer)
+            transport.start_server(server=NgStandInServer(self.stats))
+
+    def close(self):
+        self.server.close()
+# endregion
+
+# region Phase timing
+class NgPhaseTimer:
+    """Wraps NgTask methods to collect wall time and counters per phase"""
+    phases: dict[str, dict[str, float]]
+    # Phase name -> NgTask attribute. Private methods are name mangled
+    methods: dict[str, str] = {
+        "connect": "connect_remote",
+        "clean": "_NgTask__clean_target",
+        "link_dest": "_NgTask__get_link_dest_path",
+        "prepare": "_NgTask__prepare_target",
+        "rename": "_NgTask__rename_target",
+        "rotate": "_NgTask__rotate_target",
+        "close": "close_remote",
+        "synchronize": "synchronize",
+    }
+
+    def __init__(self, stats: NgBenchStats) -> None:
+        self.stats = stats
+        self.phases = {}
+        self.originals = {}
+
+    def __wrap(self, phase: str, method):
+        timer = self
+
+        def wrapper(*args, **kwargs):
+            before = timer.stats.snapshot()
+            start_time = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start_time
+                after = timer.stats.snapshot()
+                phase_stats = timer.phases.setdefault(phase, {"calls": 0, "wall": 0.0})
+                phase_stats["calls"] = phase_stats["calls"] + 1
+                phase_stats["wall"] = phase_stats["wall"] + elapsed
+                for key in after.keys():
+                    phase_stats[key] = phase_stats.get(key, 0) + after[key] - before[key]
+        return wrapper
+
+    def install(self):
+        for phase, attribute in self.methods.items():
+            method = getattr(NgTask, attribute, None)
+            if method is None:
+                continue
+            self.originals[attribute] = method
+            setattr(NgTask, attribute, self.__wrap(phase, method))
+
+    def uninstall(self):
+        for attribute, method in self.originals.items():
+            setattr(NgTask, attribute, method)
+        self.originals = {}
+
+    def report(self) -> str:
+        lines = [f"{'phase':<12} {'calls':>6} {'wall(s)':>9} {'rtts':>7} {'channels':>9} {'sftp':>7} {'up(KiB)':>9} {'down(KiB)':>10}"]
+        inner = {"calls": 0, "wall": 0.0, "round_trips": 0, "channel_opens": 0, "sftp_requests": 0, "bytes_up": 0, "bytes_down": 0}
+        for phase in self.methods.keys():
+            stats = self.phases.get(phase)
+            if not stats:
+                continue
+            if phase not in ("synchronize", "connect", "close"):
+                for key in inner.keys():
+                    inner[key] = inner[key] + stats.get(key, 0)
+            lines.append(self.__format(phase, stats))
+        sync_stats = self.phases.get("synchronize")
+        if sync_stats:
+            # Whatever synchronize spent outside the helper phases is the rsync run itself
+            rsync_stats = dict((key, sync_stats.get(key, 0) - inner[key]) for key in inner.keys())
+            rsync_stats["calls"] = sync_stats["calls"]
+            lines.append(self.__format("rsync", rsync_stats))
+        return "\n".join(lines)
+
+    @staticmethod
+    def __format(phase: str, stats: dict) -> str:
+        return f"{phase:<12} {stats.get('calls', 0):>6} {stats.get('wall', 0):>9.3f} {stats.get('round_trips', 0):>7} {stats.get('channel_opens', 0):>9} {stats.get('sftp_requests', 0):>7} {stats.get('bytes_up', 0) / 1024:>9.1f} {stats.get('bytes_down', 0) / 1024:>10.1f}"
+# endregion
+
+class NgBench:
+    """Runs NgBackup against the stand-in with a generated source tree"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.stats = NgBenchStats()
+        self.working_directory = Path(tempfile.mkdtemp(prefix="ngbench_"))
+        self.src_path = self.working_directory / "source"
+        self.dest_path = self.working_directory / "destination"
+
+    def generate_source(self):
+        rng = random.Random(self.args.seed)
+        for i in range(self.args.files):
+            path = self.src_path / f"dir{i % 10}" / f"file{i}.bin"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(rng.randbytes(self.args.file_size))
+
+    def modify_source(self):
+        rng = random.Random()
+        files = sorted(self.src_path.rglob("*.bin"))
+        for path in rng.sample(files, max(1, len(files) * self.args.change_percent // 100)):
+            path.write_bytes(rng.randbytes(self.args.file_size))
+
+    def write_config(self, port: int):
+        key_path = self.working_directory / "id_rsa"
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path.as_posix())
+        user = os.environ.get("USER", "bench")
+        config = f"""[defaults]
+inc_name_template = "%Y%m%d_%H%M%S_%f"
+ssh_key = "{key_path.as_posix()}"
+ssh_options = "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR"
+rsync_options = ''
+
+# Negative durations make every interval due on every run
+[intervals]
+hourly = -1 {self.args.rotations}
+daily = -1 {self.args.rotations}
+
+[link_intervals]
+daily = hourly
+
+[inc_name_template]
+
+[host_key]
+
+[host_port]
+127.0.0.1 = {port}
+
+[tasks]
+bench = "{self.src_path.as_posix()}" "{user}@127.0.0.1:{self.dest_path.as_posix()}"
+
+[notification_emails]
+
+[task_emails]
+"""
+        (self.working_directory / "ngbackup.ini").write_text(config)
+
+    def run(self):
+        if not shutil.which("rsync"):
+            raise RuntimeError("rsync not found in PATH")
+        stand_in = NgStandIn(self.stats)
+        proxy = NgLatencyProxy(stand_in.port, self.stats, self.args.rtt, self.args.bandwidth)
+        timer = NgPhaseTimer(self.stats)
+        current_directory = os.getcwd()
+        try:
+            self.generate_source()
+            self.write_config(proxy.port)
+            os.chdir(self.working_directory.as_posix())
+            backup = NgBackup()
+            if not self.args.verbose:
+                backup.logger.setLevel(logging.WARNING)
+            timer.install()
+            start_time = time.perf_counter()
+            for i in range(self.args.runs):
+                if i > 0:
+                    self.modify_source()
+                backup.run()
+            elapsed = time.perf_counter() - start_time
+        finally:
+            timer.uninstall()
+            os.chdir(current_directory)
+            proxy.close()
+            stand_in.close()
+
+        print(f"RTT: {self.args.rtt}ms Bandwidth: {self.args.bandwidth or 'unlimited'} KiB/s Files: {self.args.files} Runs: {self.args.runs}")
+        print(f"Working directory: {self.working_directory.as_posix()}")
+        print(timer.report())
+        print(f"Total wall time: {elapsed:.3f}s Round trips: {self.stats.round_trips} Channel opens: {self.stats.channel_opens} SFTP requests: {self.stats.sftp_requests}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark remote destination syncs against a local SSH stand-in")
+    parser.add_argument("--rtt", type=float, default=20, help="Injected round trip time in milliseconds")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Bandwidth limit per direction in KiB/s, 0 for unlimited")
+    parser.add_argument("--files", type=int, default=100, help="Number of files in the generated source")
+    parser.add_argument("--file-size", type=int, default=16384, help="Size of each generated file in bytes")
+    parser.add_argument("--change-percent", type=int, default=10, help="Percentage of files modified between runs")
+    parser.add_argument("--runs", type=int, default=3, help="Number of NgBackup runs")
+    parser.add_argument("--rotations", type=int, default=2, help="Increments kept per interval")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated source")
+    parser.add_argument("--verbose", action="store_true", help="Show NgBackup log output")
+    NgBench(parser.parse_args()).run()
+    sys.exit(0)
@@ -1,4 +1,7 @@
 from ngtask import NgTask
+from ngfilter import NgFilter
+from ngreplica import NgReplica
+from ngthrottle import NgThrottle
 from interval import Interval
 from pathlib import Path
 import os
@@ -17,13 +20,25 @@ class NgConfig:
     cygwin_home: Path
     ssh_bin: Path
     rsync_bin: Path
+    scrub_threads: int = 4
+    max_threads: int = 1
+    run_window: str = None
+    connect_timeout: float = 10
+    probe_cache_ttl: float = 60
+    ssh_options: str = ''
+    min_bwlimit: int = 65536
     # endregion
     logger = logging.getLogger("NgBackup.Config")
     intervals: dict[str, Interval] = {}
     host_key: dict[str, Path] = {}
+    host_port: dict[str, int] = {}
     rsync_tasks: dict[str, NgTask] = {}
     notification_emails: dict[str, str] = {}
     task_emails: dict[str, list] = {}
+    task_priorities: dict[str, int] = {}
+    smtp: dict[str, str] = {}
+    replicas: dict[str, list[NgReplica]] = {}
+    throttles: dict[str, NgThrottle] = {}
 
     def __init__(self) -> None:                
         self.setup_config_parser()
@@ -31,9 +46,17 @@ class NgConfig:
         self.__init_intervals()
         self.__init_inc_name_templates()
         self.__init_host_keys()
+        self.__init_host_ports()
         self.__init_sync_tasks()
+        self.__init_filters()
         self.__init_notification_emails()
+        self.__init_smtp()
         self.__init_task_emails()
+        self.__init_task_priorities()
+        self.__init_chunk_store()
+        self.__init_fanout()
+        self.__init_replicas()
+        self.__init_throttles()
 
     def setup_config_parser(self):
         working_directory = Path(os.getcwd())
@@ -90,6 +113,18 @@ class NgConfig:
     def __read_defaults(self):
         if self.__config["defaults"]["ssh_key"]:
             self.default_ssh_key = NgUtil.make_path(self.__config["defaults"]["ssh_key"].strip('"'))
+
+        self.scrub_threads = self.__config.getint("defaults", "scrub_threads", fallback=self.scrub_threads)
+        self.max_threads = self.__config.getint("defaults", "max_threads", fallback=self.max_threads)
+        self.connect_timeout = self.__config.getfloat("defaults", "connect_timeout", fallback=self.connect_timeout)
+        self.probe_cache_ttl = self.__config.getfloat("defaults", "probe_cache_ttl", fallback=self.probe_cache_ttl)
+        self.ssh_options = self.__config.get("defaults", "ssh_options", fallback=self.ssh_options).strip('"')
+        min_bwlimit = NgUtil.parse_size(self.__config.get("defaults", "min_bwlimit", fallback='').strip('"'))
+        if min_bwlimit:
+            self.min_bwlimit = min_bwlimit
+        run_window = self.__config.get("defaults", "run_window", fallback='').strip('"')
+        if run_window:
+            self.run_window = run_window
         
         if sys.platform == 'win32':
             cygwin_home = self.__config["defaults"]["cygwin_home"].strip('"')
@@ -112,6 +147,15 @@ class NgConfig:
         for k,v in self.__config.items('host_key'):
             self.host_key[k] = Path(v.strip('"'))
 
+    def __init_host_ports(self):
+        if not self.__config.has_section("host_port"):
+            return
+        for k,v in self.__config.items('host_port'):
+            try:
+                self.host_port[k] = int(v.strip('"'))
+            except ValueError:
+                self.logger.log(logging.ERROR, "Invalid port %s for host %s. Skipping...", v, k)
+
     def __init_sync_tasks(self):
         for k,v in self.__config.items('tasks'):
             self.logger.log(logging.DEBUG, "Processing Tasks K: %s V: %s", k, v.strip('"'))
@@ -125,24 +169,53 @@ class NgConfig:
                 if len(values) == 3:
                     rsync_options = values[2].strip('"')
             task: NgTask = NgTask(k, src, dest, rsync_options)
-            if task.src_host:
-                task.src_key = self.host_key.get(task.src_host, self.default_ssh_key)
-            elif task.dest_host:
-                task.dest_key = self.host_key.get(task.dest_host, self.default_ssh_key)
-            
-            if sys.platform == 'win32':
-                task.ssh_bin = self.ssh_bin
-                task.rsync_bin = self.rsync_bin
-            else:
-                task.ssh_bin = Path("/usr/bin/ssh")
-                task.rsync_bin = Path("/usr/bin/rsync")
-
+            self.__setup_task(task)
             self.rsync_tasks[k] = task
 
+    def __setup_task(self, task: NgTask):
+        if task.src_host:
+            task.src_key = self.host_key.get(task.src_host, self.default_ssh_key)
+        elif task.dest_host:
+            task.dest_key = self.host_key.get(task.dest_host, self.default_ssh_key)
+        
+        task.connect_timeout = self.connect_timeout
+        task.ssh_options = self.ssh_options
+        if task.remote_host:
+            task.ssh_port = self.host_port.get(task.remote_host.lower(), task.ssh_port)
+
+        if sys.platform == 'win32':
+            task.ssh_bin = self.ssh_bin
+            task.rsync_bin = self.rsync_bin
+        else:
+            task.ssh_bin = Path("/usr/bin/ssh")
+            task.rsync_bin = Path("/usr/bin/rsync")
+
+    def __init_filters(self):
+        global_rules: list[str] = []
+        if self.__config.has_option("filters", "rules"):
+            global_rules = self.__config.get("filters", "rules").splitlines()
+        for k,task in self.rsync_tasks.items():
+            task_rules: list[str] = []
+            if self.__config.has_option("task_filters", k):
+                task_rules = self.__config.get("task_filters", k).splitlines()
+            # Task rules come first, the first matching rule wins. "!" drops the global rules
+            if '!' in [rule.strip() for rule in task_rules]:
+                rules = task_rules
+            else:
+                rules = task_rules + global_rules
+            if rules:
+                task.filter = NgFilter(rules)
+
     def __init_notification_emails(self):
         for k,v in self.__config.items("notification_emails"):
             self.notification_emails[k] = v.strip('"')
 
+    def __init_smtp(self):
+        if not self.__config.has_section("smtp"):
+            return
+        for k,v in self.__config.items("smtp"):
+            self.smtp[k] = v.strip('"')
+
     def __init_task_emails(self):
         expr = re.compile("(?P<label>[A-Za-z0-9]+)[(\[](?P<intervals>.*)[)\]]")
         for k,v in self.__config.items("task_emails"):
@@ -165,5 +238,101 @@ class NgConfig:
                 email = self.notification_emails.get(label, None)
                 if task and email:
                     task.notifications[email] = intervals
-                    
-                        
\ No newline at end of file
+
+    def __init_task_priorities(self):
+        if not self.__config.has_section("task_priority"):
+            return
+        for k,v in self.__config.items("task_priority"):
+            try:
+                self.task_priorities[k] = int(v.strip('"'))
+            except ValueError:
+                self.logger.log(logging.ERROR, "Invalid priority %s for task %s. Skipping...", v, k)
+
+    def __init_chunk_store(self):
+        if not self.__config.has_section("chunk_store"):
+            return
+        for k,v in self.__config.items("chunk_store"):
+            task = self.rsync_tasks.get(k, None)
+            threshold = NgUtil.parse_size(v.strip('"'))
+            if not task or not threshold:
+                self.logger.log(logging.ERROR, "Invalid chunk store threshold %s for task %s. Skipping...", v, k)
+                continue
+            if task.src_remote or task.dest_remote:
+                self.logger.log(logging.WARNING, "Chunk store requires local source and destination. Ignoring for task %s", k)
+                continue
+            task.chunk_threshold = threshold
+
+    def __init_fanout(self):
+        if not self.__config.has_section("fanout"):
+            return
+        for k,v in self.__config.items("fanout"):
+            task = self.rsync_tasks.get(k, None)
+            if not task:
+                self.logger.log(logging.ERROR, "Fan-out destinations for unknown task %s. Skipping...", k)
+                continue
+            for index, dest in enumerate(v.split(), start=1):
+                destination = NgTask(f"{k}.{index}", task.src_uri, dest.strip('"'), task.rsync_options)
+                self.__setup_task(destination)
+                destination.chunk_threshold = task.chunk_threshold
+                destination.filter = task.filter
+                destination.notifications = task.notifications
+                task.fanout.append(destination)
+
+    def __get_replica_intervals(self, task_name: str) -> dict[str, Interval]:
+        """Returns copies of the intervals with the rotations configured for the replicas of a task"""
+        rotations: dict[str, int] = {}
+        if self.__config.has_option("replica_rotations", task_name):
+            for value in self.__config.get("replica_rotations", task_name).strip('"').split():
+                name, _, count = value.partition('=')
+                try:
+                    rotations[name] = int(count)
+                except ValueError:
+                    self.logger.log(logging.ERROR, "Invalid replica rotations %s for task %s. Skipping...", value, task_name)
+
+        intervals: dict[str, Interval] = {}
+        for k,interval in self.intervals.items():
+            link = None
+            if interval.link:
+                link = intervals.get(interval.link.name, None)
+            intervals[k] = Interval(k, interval.duration, rotations.get(k, interval.rotations), interval.inc_name_template, link)
+        return intervals
+
+    def __init_replicas(self):
+        if not self.__config.has_section("replicas"):
+            return
+        for k,v in self.__config.items("replicas"):
+            task = self.rsync_tasks.get(k, None)
+            if not task:
+                self.logger.log(logging.ERROR, "Replicas for unknown task %s. Skipping...", k)
+                continue
+            if task.dest_remote or task.chunk_threshold:
+                self.logger.log(logging.ERROR, "Replication needs a local destination without chunk store. Skipping task %s", k)
+                continue
+            intervals = self.__get_replica_intervals(k)
+            for index, dest in enumerate(v.split(), start=1):
+                tier = NgTask(f"{k}.replica{index}", task.dest_uri, dest.strip('"'), f"-H {task.rsync_options}")
+                self.__setup_task(tier)
+                self.replicas.setdefault(k, []).append(NgReplica(task, tier, intervals))
+
+    def __init_throttles(self):
+        """Creates one throttle per task or host in [bandwidth] / [io_priority], shared by all its transfers"""
+        schedules: dict[str, list[str]] = {}
+        for index, section in enumerate(["bandwidth", "io_priority"]):
+            if not self.__config.has_section(section):
+                continue
+            for k,v in self.__config.items(section):
+                schedules.setdefault(k, ['', ''])[index] = v.strip('"')
+        for k,(schedule, io_schedule) in schedules.items():
+            self.throttles[k] = NgThrottle(k, schedule, io_schedule, self.min_bwlimit)
+        if not self.throttles:
+            return
+
+        tasks: list[NgTask] = []
+        for task in self.rsync_tasks.values():
+            tasks.append(task)
+            tasks.extend(task.fanout)
+        for replicas in self.replicas.values():
+            tasks.extend(replica.tier for replica in replicas)
+        # A task schedule takes precedence over the schedule of its host
+        for task in tasks:
+            task.throttle = self.throttles.get(task.name) or self.throttles.get((task.remote_host or '').lower())
@@ -0,0 +1,214 @@
+from pathlib import Path
+import json
+import logging
+import os
+import re
+
+class NgFilter:
+    """Include/exclude rules of a task, compiled into an rsync merge file.
+
+    Rules use the rsync filter syntax ("- node_modules/", "+ keep.log") and
+    "profile:<name>" expands to one of the built-in profiles. Rules are
+    checked in order and the first match wins, so task rules placed before
+    the global rules can override them. "!" clears the rules before it, like
+    in rsync.
+
+    An excluded directory is pruned, its contents are never checked. To keep
+    a path inside it, the directory has to be included, then the path, then
+    the rest of the directory excluded:
+    "+ .cache/", "+ .cache/keep/***", "- .cache/*".
+    """
+    profiles: dict[str, list[str]] = {
+        "dev": [
+            "- node_modules/",
+            "- __pycache__/",
+            "- *.py[co]",
+            "- .tox/",
+            "- .nox/",
+            "- .mypy_cache/",
+            "- .pytest_cache/",
+            "- .ruff_cache/",
+            "- .gradle/",
+            "- .sass-cache/",
+        ],
+        "cache": [
+            "- .cache/",
+            "- Cache/",
+            "- cache2/",
+            "- .thumbnails/",
+            "- Thumbs.db",
+            "- .DS_Store",
+            "- .Trash-*/",
+            "- $RECYCLE.BIN/",
+            "- *.tmp",
+            "- ~$*",
+        ],
+        "vm": [
+            "- *.vswp",
+            "- *.vmem",
+            "- *.vmss",
+            "- pagefile.sys",
+            "- hiberfil.sys",
+            "- swapfile.sys",
+            "- swapfile",
+            "- *.swp",
+        ],
+    }
+
+    rules: list[str]
+    logger: logging.Logger
+
+    def __init__(self, rules: list[str]) -> None:
+        self.logger = logging.getLogger("NgBackup.Filter")
+        self.rules = []
+        self.__expressions: dict[str, re.Pattern] = {}
+        for rule in rules:
+            rule = rule.strip().strip('"')
+            if not rule or rule.startswith('#'):
+                continue
+            if rule.startswith("profile:"):
+                profile = self.profiles.get(rule[len("profile:"):])
+                if profile is None:
+                    self.logger.log(logging.ERROR, "Unknown filter profile %s. Skipping...", rule)
+                    continue
+                self.rules.extend(profile)
+            elif rule == '!':
+                self.rules = []
+            elif rule[0] in "+-" and rule[1:2] == ' ':
+                self.rules.append(rule)
+            else:
+                self.logger.log(logging.ERROR, "Invalid filter rule %s. Expected '+ pattern' or '- pattern'", rule)
+
+    def write(self, filter_path: Path) -> bool:
+        """Writes the rules as rsync merge file"""
+        try:
+            with open(filter_path.as_posix(), 'w') as fh:
+                fh.write(''.join(f"{rule}\n" for rule in self.rules))
+            return True
+        except Exception:
+            self.logger.log(logging.ERROR, "Could not write filter file %s", filter_path.as_posix())
+            return False
+
+    # region Matching
+    @staticmethod
+    def __translate(pattern: str) -> str:
+        """Translates rsync wildcards to a regular expression
+
+        "*" and "?" stop at "/", "**" also matches "/" and a trailing "dir/***"
+        matches dir and everything below it.
+        """
+        expression = ''
+        trailing = ''
+        if pattern.endswith('/***'):
+            pattern = pattern[:-4]
+            trailing = '(?:/.*)?'
+        i = 0
+        while i < len(pattern):
+            char = pattern[i]
+            if pattern.startswith('**', i):
+                expression = expression + '.*'
+                i = i + 2
+                continue
+            if char == '*':
+                expression = expression + '[^/]*'
+            elif char == '?':
+                expression = expression + '[^/]'
+            elif char == '[':
+                end = pattern.find(']', i + 2)
+                if end == -1:
+                    expression = expression + re.escape(char)
+                else:
+                    members = pattern[i + 1:end]
+                    if members.startswith('!'):
+                        members = '^' + members[1:]
+                    expression = expression + f"[{members}]"
+                    i = end
+            elif char == '\\' and i + 1 < len(pattern):
+                i = i + 1
+                expression = expression + re.escape(pattern[i])
+            else:
+                expression = expression + re.escape(char)
+            i = i + 1
+        return expression + trailing
+
+    def __compile(self, pattern: str) -> re.Pattern:
+        expression = self.__expressions.get(pattern)
+        if expression is None:
+            body = pattern.rstrip('/') if pattern.endswith('/') and not pattern.endswith('/***') else pattern
+            if body.startswith('/'):
+                # Anchored at the transfer root
+                expression = re.compile(self.__translate(body[1:]))
+            else:
+                # Matched against the end of the path, at a directory boundary. "*" and "?"
+                # do not match "/", so a pattern without one matches the last path component
+                expression = re.compile('(?:.*/)?' + self.__translate(body))
+            self.__expressions[pattern] = expression
+        return expression
+
+    def __match_pattern(self, pattern: str, relative: str, is_dir: bool) -> bool:
+        """Matches a path relative to the transfer root like rsync does"""
+        if pattern.endswith('/') and not is_dir:
+            return False
+        return self.__compile(pattern).fullmatch(relative) is not None
+
+    def match(self, relative: str, is_dir: bool) -> str:
+        """Returns the first rule matching the path, None if no rule matches"""
+        for rule in self.rules:
+            if self.__match_pattern(rule[2:], relative, is_dir):
+                return rule
+        return None
+    # endregion
+
+    # region Report
+    def measure(self, increment_path: Path) -> dict[str, dict[str, list[int]]]:
+        """Walks an increment and sums files and bytes of every subtree an exclude rule would skip
+
+        Returns:
+            dict[str, dict[str, list[int]]]: rule -> excluded path -> [files, bytes]
+        """
+        savings: dict[str, dict[str, list[int]]] = {}
+        increment_path = Path(increment_path.as_posix())
+        for root, dirs, files in os.walk(increment_path.as_posix()):
+            relative_root = Path(root).relative_to(increment_path).as_posix()
+            relative_root = '' if relative_root == '.' else f"{relative_root}/"
+            for name in list(dirs):
+                rule = self.match(f"{relative_root}{name}", True)
+                if rule and rule.startswith('-'):
+                    dirs.remove(name)
+                    savings.setdefault(rule, {})[f"{relative_root}{name}/"] = self.__tree_size(Path(root) / name)
+            for name in files:
+                rule = self.match(f"{relative_root}{name}", False)
+                if rule and rule.startswith('-'):
+                    try:
+                        size = os.lstat(os.path.join(root, name)).st_size
+                    except OSError:
+                        continue
+                    savings.setdefault(rule, {})[f"{relative_root}{name}"] = [1, size]
+        return savings
+
+    @staticmethod
+    def __tree_size(path: Path) -> list[int]:
+        count = 0
+        size = 0
+        for root, dirs, files in os.walk(path.as_posix()):
+            for name in files:
+                try:
+                    size = size + os.lstat(os.path.join(root, name)).st_size
+                    count = count + 1
+                except OSError:
+                    pass
+        return [count, size]
+
+    @staticmethod
+    def load_report(report_path: Path) -> dict:
+        try:
+            with open(report_path.as_posix(), 'r') as fh:
+                return json.load(fh)
+        except Exception:
+            return None
+
+    @staticmethod
+    def save_report(report_path: Path, report: dict):
+        with open(report_path.as_posix(), 'w') as fh:
+            json.dump(report, fh, indent=1)
+    # endregion
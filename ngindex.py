@@ -0,0 +1,110 @@
+from pathlib import Path
+from typing import Callable
+import json
+import logging
+import os
+
+class NgIncrementIndex:
+    """Cached listing of the increments in the interval directories of a destination.
+
+    Each interval directory is listed once and kept with its mtime in
+    control/index_<name>_<uid>.json. A lookup only stats the directory and
+    lists it again when the mtime changed, which happens when increments
+    are created, renamed or deleted by someone else. The task's own changes
+    go through change, which updates the listing in place and records the
+    new mtime, so cleanup, link-dest lookup and rotation share one listing
+    per run, and the next run starts from the persisted one. A change made
+    while the cached listing is out of date, or one that leaves the mtime
+    unchanged (SFTP mtimes have one second resolution), drops the listing
+    instead, so it is listed again on the next lookup.
+
+    stat and listdir work on local or remote (SFTP) paths. stat returns the
+    directory mtime, None if it does not exist; listdir returns the entry
+    names, None on failure.
+    """
+    index_path: Path
+    logger: logging.Logger
+
+    def __init__(self, name: str, uid: str, stat: Callable[[Path], float], listdir: Callable[[Path], list[str]]) -> None:
+        self.index_path = Path(os.getcwd()) / "control" / f"index_{name}_{uid}.json"
+        self.__stat = stat
+        self.__listdir = listdir
+        self.logger = logging.getLogger(f"NgBackup.Index.{name}")
+        self.__entries: dict[str, dict] = self.__load()
+
+    # region Persistence
+    def __load(self) -> dict[str, dict]:
+        try:
+            with open(self.index_path.as_posix(), 'r') as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            self.logger.log(logging.WARNING, "Could not read increment index %s. Rebuilding", self.index_path.as_posix())
+            return {}
+
+    def __save(self):
+        temp_path = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+        try:
+            with open(temp_path.as_posix(), 'w') as fh:
+                json.dump(self.__entries, fh)
+            os.replace(temp_path.as_posix(), self.index_path.as_posix())
+        except Exception:
+            self.logger.log(logging.ERROR, "Could not write increment index %s", self.index_path.as_posix())
+    # endregion
+
+    def list(self, interval_path: Path) -> list[str]:
+        """Returns the sorted entry names of the interval directory, None if it does not exist"""
+        key = interval_path.as_posix()
+        mtime = self.__stat(interval_path)
+        if mtime is None:
+            if self.__entries.pop(key, None) is not None:
+                self.__save()
+            return None
+
+        entry = self.__entries.get(key)
+        if entry and entry["mtime"] == mtime:
+            return list(entry["names"])
+
+        names = self.__listdir(interval_path)
+        if names is None:
+            return None
+        self.logger.log(logging.DEBUG, "Listed %d entries of %s", len(names), key)
+        self.__entries[key] = {"mtime": mtime, "names": sorted(names)}
+        self.__save()
+        return sorted(names)
+
+    def change(self, interval_path: Path, action: Callable[[], bool], remove: str = None, add: str = None) -> bool:
+        """Runs action, which creates, renames or deletes an entry of the interval directory, and updates the listing
+
+        Args:
+            interval_path (Path): Interval directory
+            action (Callable[[], bool]): Makes the change, returns False if it failed
+            remove (str, optional): Entry the change removes. Defaults to None.
+            add (str, optional): Entry the change adds. Defaults to None.
+
+        Returns:
+            bool: Result of action
+        """
+        key = interval_path.as_posix()
+        entry = self.__entries.get(key)
+        if not entry:
+            # Not listed yet, the next lookup lists the directory
+            return action()
+        before = self.__stat(interval_path)
+        status = False
+        try:
+            status = action()
+        finally:
+            after = self.__stat(interval_path) if status else None
+            if not status or before != entry["mtime"] or after is None or after == before:
+                # Changed by someone else since the listing, or the change is not visible in the mtime
+                del self.__entries[key]
+            else:
+                names = [name for name in entry["names"] if name != remove]
+                if add and add not in names:
+                    names.append(add)
+                entry["names"] = sorted(names)
+                entry["mtime"] = after
+            self.__save()
+        return status
@@ -0,0 +1,96 @@
+from ngtask import NgTask
+from pathlib import Path
+import logging
+import os
+import sys
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+class NgLock:
+    """OS lock on a lock file, held while a task is in progress.
+
+    Each task (source, destination and name, see NgTask.uid) has its own lock
+    file in the control folder, so overlapping NgMain invocations only skip
+    the tasks that are still running. The lock is held on an open file
+    descriptor (flock, or msvcrt.locking on Windows), so the OS releases it
+    when the process exits or crashes and there are no stale locks to take
+    over. The file stays in place and only records the PID of the holder for
+    the log.
+    """
+    task: NgTask
+    lock_path: Path
+    logger: logging.Logger
+    __fd: int = None
+
+    def __init__(self, task: NgTask) -> None:
+        self.task = task
+        current_directory = Path(os.getcwd())
+        lock_directory = current_directory / "control" / "locks"
+        if not lock_directory.exists():
+            lock_directory.mkdir(parents=True, exist_ok=True)
+        self.lock_path = lock_directory / f"{task.name}_{task.uid}.lock"
+        self.logger = logging.getLogger(f"NgBackup.Lock.{task.name}")
+
+    @staticmethod
+    def __try_lock(fd: int) -> bool:
+        try:
+            if sys.platform == 'win32':
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def __unlock(fd: int):
+        if sys.platform == 'win32':
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def __get_owner(self) -> str:
+        try:
+            with open(self.lock_path.as_posix(), 'r') as fh:
+                return fh.readline().strip('\n') or None
+        except Exception:
+            return None
+
+    def is_locked(self) -> bool:
+        fd = os.open(self.lock_path.as_posix(), os.O_RDWR | os.O_CREAT)
+        try:
+            if self.__try_lock(fd):
+                self.__unlock(fd)
+                return False
+            return True
+        finally:
+            os.close(fd)
+
+    def acquire(self) -> bool:
+        fd = os.open(self.lock_path.as_posix(), os.O_RDWR | os.O_CREAT)
+        if not self.__try_lock(fd):
+            os.close(fd)
+            self.logger.log(logging.INFO, "Task %s is locked by process %s", self.task.name, self.__get_owner())
+            return False
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, str(os.getpid()).encode())
+        self.__fd = fd
+        return True
+
+    def release(self):
+        if self.__fd is None:
+            return
+        try:
+            # The file is not removed. Unlinking it would let another process lock a new file while this one is still locked
+            os.ftruncate(self.__fd, 0)
+            self.__unlock(self.__fd)
+            os.close(self.__fd)
+        except Exception:
+            self.logger.log(logging.ERROR, "Could not release lock file %s", self.lock_path.as_posix())
+        self.__fd = None
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3.9
+from email.message import EmailMessage
+from pathlib import Path
+import argparse
+import itertools
+import json
+import logging
+import os
+import psutil
+import smtplib
+import socket
+import socketserver
+import threading
+import time
+
+class NgNotifier:
+    """Queues backup results on disk and mails them from a background thread.
+
+    Backup threads only call enqueue, which writes one small file per
+    recipient to control/notifications. The worker drains the queue every
+    batch_delay seconds and sends one digest per recipient and interval.
+    Failed deliveries stay queued and are retried with exponential backoff.
+    The attempt count and the next retry time are stored in the queued
+    events, so later runs keep backing off instead of retrying right away.
+    """
+    host: str
+    port: int
+    sender: str
+    user: str
+    password: str
+    starttls: bool
+    batch_delay: float
+    timeout: float = 30
+    max_backoff: float = 3600
+    queue_path: Path
+    logger: logging.Logger
+
+    __counter = itertools.count()
+
+    def __init__(self, host: str, port: int = 25, sender: str = 'ngbackup@localhost', user: str = None, password: str = None, starttls: bool = False, batch_delay: float = 60) -> None:
+        self.host = host
+        self.port = int(port)
+        self.sender = sender
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.batch_delay = float(batch_delay)
+        self.queue_path = Path(os.getcwd()) / "control" / "notifications"
+        self.queue_path.mkdir(parents=True, exist_ok=True)
+        self.logger = logging.getLogger("NgBackup.Notifier")
+        self.__wakeup = threading.Event()
+        self.__stopping = False
+        self.__worker: threading.Thread = None
+
+    def enqueue(self, recipient: str, task_name: str, interval_name: str, success: bool, message: str, skipped: bool = False):
+        """Queues a backup result for recipient. Never blocks on mail delivery. A skipped task is not counted as failed"""
+        event = {
+            "recipient": recipient,
+            "task": task_name,
+            "interval": interval_name,
+            "success": success,
+            "skipped": skipped,
+            "message": message,
+            "time": int(time.time()),
+            "attempts": 0,
+            "retry_time": 0,
+        }
+        name = f"{time.time_ns()}_{os.getpid()}_{next(self.__counter)}"
+        temp_path = self.queue_path / f"{name}.tmp"
+        try:
+            with open(temp_path.as_posix(), 'w') as fh:
+                json.dump(event, fh)
+            os.replace(temp_path.as_posix(), (self.queue_path / f"{name}.json").as_posix())
+        except Exception:
+            self.logger.log(logging.ERROR, "Could not queue notification for %s", recipient)
+
+    # region Worker
+    def start(self):
+        if self.__worker:
+            return
+        self.__stopping = False
+        self.__recover_claims()
+        self.__worker = threading.Thread(target=self.__run, name="NgNotifier", daemon=True)
+        self.__worker.start()
+
+    def stop(self):
+        """Stops the worker after a final attempt to send what is queued"""
+        if not self.__worker:
+            return
+        self.__stopping = True
+        self.__wakeup.set()
+        self.__worker.join()
+        self.__worker = None
+
+    def __run(self):
+        while not self.__stopping:
+            self.__wakeup.wait(self.batch_delay)
+            self.__wakeup.clear()
+            self.drain()
+        self.drain()
+
+    def __load_events(self) -> list[tuple[Path, dict]]:
+        """Claims queued events by renaming them, so other NgMain instances do not send them too"""
+        events: list[tuple[Path, dict]] = []
+        for path in sorted(self.queue_path.glob('*.json')):
+            claimed_path = path.with_name(f"{path.name}.{os.getpid()}")
+            try:
+                os.rename(path.as_posix(), claimed_path.as_posix())
+            except OSError:
+                continue
+            try:
+                with open(claimed_path.as_posix(), 'r') as fh:
+                    events.append((claimed_path, json.load(fh)))
+            except Exception:
+                self.logger.log(logging.ERROR, "Dropping unreadable notification %s", path.as_posix())
+                claimed_path.unlink()
+        return events
+
+    def __release_events(self, events: list[tuple[Path, dict]], attempts: int = None, retry_time: float = None):
+        """Returns claimed events to the queue, recording the backoff of a failed delivery if given"""
+        for claimed_path, event in events:
+            if attempts is not None:
+                event["attempts"] = attempts
+                event["retry_time"] = retry_time
+                try:
+                    with open(claimed_path.as_posix(), 'w') as fh:
+                        json.dump(event, fh)
+                except Exception:
+                    self.logger.log(logging.ERROR, "Could not record backoff in %s", claimed_path.as_posix())
+            os.rename(claimed_path.as_posix(), claimed_path.with_suffix('').as_posix())
+
+    def __recover_claims(self):
+        """Returns events claimed by instances that are no longer running to the queue"""
+        for claimed_path in self.queue_path.glob('*.json.*'):
+            try:
+                pid = int(claimed_path.suffix[1:])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not psutil.pid_exists(pid):
+                os.rename(claimed_path.as_posix(), claimed_path.with_suffix('').as_posix())
+
+    def drain(self):
+        """Sends one digest per recipient and interval for all queued events"""
+        digests: dict[tuple[str, str], list[tuple[Path, dict]]] = {}
+        # Backoff per recipient, from the attempts recorded in its queued events
+        backoff: dict[str, tuple[int, float]] = {}
+        for path, event in self.__load_events():
+            digests.setdefault((event["recipient"], event["interval"]), []).append((path, event))
+            attempts, retry_time = backoff.get(event["recipient"], (0, 0))
+            backoff[event["recipient"]] = (max(attempts, event.get("attempts", 0)), max(retry_time, event.get("retry_time", 0)))
+
+        now = time.time()
+        server_down = False
+        for (recipient, interval_name), events in digests.items():
+            attempts, retry_time = backoff.get(recipient, (0, 0))
+            if server_down or now < retry_time:
+                self.__release_events(events)
+                continue
+            try:
+                self.send(recipient, self.__build_digest(recipient, interval_name, [event for path, event in events]))
+            except Exception as ex:
+                attempts = attempts + 1
+                delay = min(self.batch_delay * (2 ** attempts), self.max_backoff)
+                backoff[recipient] = (attempts, now + delay)
+                self.logger.log(logging.WARNING, "Could not send notification to %s (attempt %d): %s. Retrying in %ds", recipient, attempts, ex, delay)
+                self.__release_events(events, attempts, now + delay)
+                # No point waiting for the timeout of every other digest
+                server_down = isinstance(ex, (ConnectionError, socket.timeout, smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected))
+                continue
+            for path, event in events:
+                path.unlink()
+            self.logger.log(logging.INFO, "Sent %s digest with %d results to %s", interval_name, len(events), recipient)
+    # endregion
+
+    def __build_digest(self, recipient: str, interval_name: str, events: list[dict]) -> EmailMessage:
+        failed = [event for event in events if not event["success"] and not event.get("skipped")]
+        skipped = [event for event in events if event.get("skipped")]
+        status = f"{len(failed)} FAILED" if failed else "OK"
+        if skipped:
+            status = f"{status}, {len(skipped)} SKIPPED"
+        lines = []
+        for event in events:
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event["time"]))
+            result = "SKIPPED" if event.get("skipped") else "OK" if event["success"] else "FAILED"
+            lines.append(f"{timestamp} {event['task']} {result} {event['message']}")
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = recipient
+        message["Subject"] = f"NgBackup {interval_name} report: {len(events)} results, {status}"
+        message.set_content("\n".join(lines) + "\n")
+        return message
+
+    def send(self, recipient: str, message: EmailMessage):
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password)
+            smtp.send_message(message, self.sender, [recipient])
+
+# region SMTP stand-in
+class NgSmtpStandIn(socketserver.ThreadingTCPServer):
+    """Minimal SMTP server for testing notifications without a mail server.
+
+    Accepts every message and writes it to outbox_path as <n>.eml.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int, outbox_path: Path) -> None:
+        self.outbox_path = outbox_path
+        self.outbox_path.mkdir(parents=True, exist_ok=True)
+        self.counter = itertools.count(len(list(outbox_path.glob('*.eml'))))
+        super().__init__(("127.0.0.1", port), NgSmtpStandInHandler)
+
+class NgSmtpStandInHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode('utf8'))
+
+    def handle(self):
+        self.reply("220 ngbackup stand-in ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf8', errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply("250 ngbackup stand-in")
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply("250 OK")
+            elif verb == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                path = self.server.outbox_path / f"{next(self.server.counter)}.eml"
+                path.write_bytes(b''.join(data))
+                self.reply("250 OK queued")
+            elif verb == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+# endregion
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local SMTP stand-in for testing notifications")
+    parser.add_argument("--port", type=int, default=1025, help="Port to listen on (127.0.0.1)")
+    parser.add_argument("--outbox", default="logs/outbox", help="Folder received messages are written to")
+    args = parser.parse_args()
+    server = NgSmtpStandIn(args.port, Path(args.outbox))
+    print(f"SMTP stand-in listening on 127.0.0.1:{args.port}, writing to {args.outbox}")
+    server.serve_forever()
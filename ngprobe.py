@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import socket
+import threading
+import time
+
+class NgProbe:
+    """Checks that SSH hosts are reachable before any task connects to them.
+
+    A probe opens a TCP connection and waits for the SSH banner, both with a
+    hard timeout. Hosts are probed concurrently and the results are cached
+    for cache_ttl seconds, so tasks sharing a dead host do not wait on it
+    again.
+    """
+    timeout: float
+    cache_ttl: float
+    logger: logging.Logger
+
+    __cache: dict[tuple[str, int], tuple[bool, float]] = {}
+    __lock = threading.Lock()
+
+    def __init__(self, timeout: float = 5, cache_ttl: float = 60) -> None:
+        """Initializes the probe
+
+        Args:
+            timeout (float, optional): Seconds allowed for TCP connect and for the SSH banner. Defaults to 5.
+            cache_ttl (float, optional): Seconds a probe result is reused. Defaults to 60.
+        """
+        self.timeout = float(timeout)
+        self.cache_ttl = float(cache_ttl)
+        self.logger = logging.getLogger("NgBackup.Probe")
+
+    def __probe(self, host: str, port: int) -> bool:
+        start_time = time.time()
+        try:
+            with socket.create_connection((host, port), timeout=self.timeout) as sock:
+                # The timeout covers the whole banner, not each recv of a host trickling it out
+                deadline = time.time() + self.timeout
+                banner = b''
+                while b'\n' not in banner and len(banner) < 256:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout("timed out waiting for SSH banner")
+                    sock.settimeout(remaining)
+                    data = sock.recv(256)
+                    if not data:
+                        break
+                    banner = banner + data
+        except OSError as ex:
+            self.logger.log(logging.WARNING, "Host %s:%d is not reachable: %s", host, port, ex)
+            return False
+
+        if not banner.startswith(b'SSH-'):
+            self.logger.log(logging.WARNING, "Host %s:%d did not send an SSH banner", host, port)
+            return False
+        self.logger.log(logging.DEBUG, "Host %s:%d is reachable (%.2fs) %s", host, port, time.time() - start_time, banner.strip().decode('utf8', errors='replace'))
+        return True
+
+    def __get_cached(self, host: str, port: int) -> bool:
+        with self.__lock:
+            entry = self.__cache.get((host, port))
+        if entry and time.time() - entry[1] < self.cache_ttl:
+            return entry[0]
+        return None
+
+    def is_reachable(self, host: str, port: int = 22) -> bool:
+        """Returns the cached result for the host, probing it if the result has expired"""
+        status = self.__get_cached(host, port)
+        if status is None:
+            status = self.__probe(host, port)
+            with self.__lock:
+                self.__cache[(host, port)] = (status, time.time())
+        return status
+
+    def probe_all(self, hosts: set[tuple[str, int]]) -> dict[tuple[str, int], bool]:
+        """Probes all (host, port) pairs concurrently
+
+        Returns:
+            dict[tuple[str, int], bool]: Reachability per (host, port)
+        """
+        hosts = list(hosts)
+        if not hosts:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(len(hosts), 16)) as executor:
+            results = executor.map(lambda host: self.is_reachable(*host), hosts)
+            return dict(zip(hosts, results))
@@ -5,6 +5,7 @@ from paramiko.client import AutoAddPolicy, SSHClient
 from paramiko.rsakey import RSAKey
 from paramiko.ssh_exception import AuthenticationException, BadHostKeyException, SSHException
 import logging
+import time
 
 class NgRemote:
     host: str
@@ -23,9 +24,9 @@ class NgRemote:
         self.__ssh_client.set_missing_host_key_policy(AutoAddPolicy())
         self.logger = logging.getLogger(f"NgBackup.NgRemote.{self.user}_{self.host}")        
 
-    def connect(self):
+    def connect(self, timeout: float = None):
         try:
-            self.__ssh_client.connect(hostname=self.host, port=self.port, username=self.user, pkey=self.private_key)            
+            self.__ssh_client.connect(hostname=self.host, port=self.port, username=self.user, pkey=self.private_key, timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
             self.logger.log(logging.INFO, "Connected successfully")
         except AuthenticationException as ae:
             self.logger.log(logging.ERROR, "Connect: %s", ae)
@@ -49,6 +50,18 @@ class NgRemote:
         else:
             return False
 
+    def get_latency(self) -> float:
+        """Round trip time of an SSH keepalive on the open connection in seconds, None if it fails"""
+        transport = self.__ssh_client.get_transport()
+        if not transport or not transport.is_active():
+            return None
+        start_time = time.time()
+        try:
+            transport.global_request("keepalive@openssh.com", wait=True)
+        except Exception:
+            return None
+        return time.time() - start_time
+
     @property
     def is_alive(self) -> bool:
         return self.check_status()
@@ -65,6 +78,18 @@ class NgRemote:
             self.logger.log(logging.ERROR, "Failed to list the path %s", path.as_posix())
             return False
     
+    def get_mtime(self, path: Path) -> int:
+        """Returns the modification time of path, None if it does not exist"""
+        transport = self.__ssh_client.get_transport()
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        try:
+            return sftp.stat(path.as_posix()).st_mtime
+        except FileNotFoundError as ex:
+            return None
+        except Exception as ex:
+            self.logger.log(logging.ERROR, "Failed to stat the path %s", path.as_posix())
+            return None
+
     def listdir(self, path: Path) -> list[Path]:
         transport = self.__ssh_client.get_transport()
         sftp = paramiko.SFTPClient.from_transport(transport)
@@ -0,0 +1,114 @@
+from interval import Interval
+from ngtask import NgTask
+from pathlib import Path
+import logging
+import os
+
+class NgReplica:
+    """Replicates finished increments of a task's local destination to another tier.
+
+    Increments are copied in order under their original name. Each copy uses
+    the previously replicated increment as link-dest (and -H within the
+    increment), so hard links between consecutive increments are preserved
+    on the tier. The tier is rotated with its own rotations per interval.
+
+    What has been replicated is decided by the tier's own listing, so a lost
+    or unreadable checkpoint only costs a listing. The checkpoint per
+    interval in the control folder is a shortcut: when it already holds the
+    newest increment of the source, the tier is not listed at all.
+    """
+    task: NgTask
+    tier: NgTask
+    intervals: dict[str, Interval]
+    logger: logging.Logger
+
+    def __init__(self, task: NgTask, tier: NgTask, intervals: dict[str, Interval]) -> None:
+        """Initializes the replica
+
+        Args:
+            task (NgTask): Task whose local destination is replicated
+            tier (NgTask): Task describing the tier (source is the local destination of task)
+            intervals (dict[str, Interval]): Intervals with the rotations of the tier
+        """
+        self.task = task
+        self.tier = tier
+        self.intervals = intervals
+        self.logger = logging.getLogger(f"NgBackup.Replica.{tier.name}")
+
+    # region Checkpoint
+    def __get_checkpoint_path(self, interval: Interval) -> Path:
+        current_directory = Path(os.getcwd())
+        return current_directory / "control" / f"replica_{interval.name}_{self.tier.name}_{self.tier.uid}"
+
+    def __read_checkpoint(self, interval: Interval) -> list[str]:
+        checkpoint_path = self.__get_checkpoint_path(interval)
+        if not checkpoint_path.exists():
+            return []
+        try:
+            with open(checkpoint_path.as_posix(), 'r') as fh:
+                return [line.strip('\n') for line in fh if line.strip('\n')]
+        except Exception:
+            self.logger.log(logging.ERROR, "Could not read checkpoint %s", checkpoint_path.as_posix())
+            return []
+
+    def __write_checkpoint(self, interval: Interval, replicated: list[str]):
+        checkpoint_path = self.__get_checkpoint_path(interval)
+        temp_path = checkpoint_path.with_name(f"{checkpoint_path.name}.tmp")
+        try:
+            with open(temp_path.as_posix(), 'w') as fh:
+                fh.write(''.join(f"{name}\n" for name in replicated))
+            os.replace(temp_path.as_posix(), checkpoint_path.as_posix())
+        except Exception:
+            self.logger.log(logging.ERROR, "Could not write checkpoint %s", checkpoint_path.as_posix())
+    # endregion
+
+    def __get_increments(self, interval: Interval) -> list[Path]:
+        interval_path = Path(self.task.dest_path.as_posix()) / interval.name
+        if not interval_path.exists():
+            return []
+        return [path for path in sorted(interval_path.glob('*')) if path.is_dir() and not path.name.endswith("_temp")]
+
+    def __get_tier_increments(self, interval: Interval) -> list[str]:
+        interval_path = Path((self.tier.dest_path / interval.name).as_posix())
+        names = self.tier.increment_index.list(interval_path) or []
+        return [name for name in names if not name.endswith("_temp")]
+
+    def replicate(self, interval: Interval) -> bool:
+        """Replicates the increments of the interval that are newer than the last one on the tier"""
+        tier_interval = self.intervals.get(interval.name, interval)
+        checkpoint = self.__read_checkpoint(interval)
+        increments = self.__get_increments(interval)
+        if not increments or (checkpoint and checkpoint[-1] >= increments[-1].name):
+            self.logger.log(logging.DEBUG, "No %s increments to replicate", interval.name)
+            return True
+
+        # The checkpoint may be behind or lost, the tier listing decides
+        replicated = self.__get_tier_increments(interval)
+        last_replicated = replicated[-1] if replicated else None
+        pending = [path for path in increments if path.name not in replicated and (not last_replicated or path.name > last_replicated)]
+        if replicated != checkpoint:
+            self.logger.log(logging.INFO, "Rebuilt %s checkpoint from %d increments on %s", interval.name, len(replicated), self.tier.dest_uri)
+            self.__write_checkpoint(interval, replicated)
+        if not pending:
+            self.logger.log(logging.DEBUG, "No %s increments to replicate", interval.name)
+            return True
+
+        self.logger.log(logging.INFO, "Replicating %d %s increments to %s", len(pending), interval.name, self.tier.dest_uri)
+        for increment_path in pending:
+            if not self.tier.replicate_increment(tier_interval, increment_path.name, increment_path, last_replicated):
+                self.logger.log(logging.ERROR, "Failed to replicate %s. Will resume from here on the next run", increment_path.as_posix())
+                return False
+            last_replicated = increment_path.name
+            replicated.append(last_replicated)
+            # Only the increments still present at the source are needed to resume
+            names = set(path.name for path in increments)
+            self.__write_checkpoint(interval, [name for name in replicated if name in names])
+            self.logger.log(logging.INFO, "Replicated %s increment %s", interval.name, last_replicated)
+        return True
+
+    def run(self) -> bool:
+        status = True
+        for interval in self.intervals.values():
+            if not self.replicate(interval):
+                status = False
+        return status
@@ -0,0 +1,183 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from interval import Interval
+from ngtask import NgTask
+from pathlib import Path
+from typing import Callable
+import json
+import logging
+import os
+import threading
+import time
+
+class NgScheduler:
+    """Orders due tasks using the durations recorded on previous runs.
+
+    Tasks are started highest priority first and, within the same priority,
+    longest expected duration first. With more than one thread this is the
+    classic longest-processing-time list schedule, which keeps the slowest
+    task from starting last and stretching the whole run. Tasks whose
+    expected duration does not fit before the end of the run window are
+    deferred to the next run, and outside the window nothing is started.
+    """
+    max_threads: int
+    window: str
+    priorities: dict[str, int]
+    history: dict[str, dict[str, list]]
+    history_size: int = 10
+    logger: logging.Logger
+    __lock: threading.Lock
+
+    def __init__(self, max_threads: int = 1, window: str = None, priorities: dict[str, int] = None) -> None:
+        """Initializes the scheduler
+
+        Args:
+            max_threads (int, optional): Maximum tasks run in parallel. Defaults to 1.
+            window (str, optional): Run window as HH:MM-HH:MM, may cross midnight. Defaults to None.
+            priorities (dict[str, int], optional): Task name to priority, higher runs first. Defaults to None.
+        """
+        self.max_threads = max(1, int(max_threads))
+        self.window = window
+        self.priorities = priorities if priorities else {}
+        self.logger = logging.getLogger("NgBackup.Scheduler")
+        self.__lock = threading.Lock()
+        self.history = self.__load_history()
+
+    # region History
+    def __get_history_path(self) -> Path:
+        current_directory = Path(os.getcwd())
+        return current_directory / "control" / "history.json"
+
+    def __load_history(self) -> dict:
+        history_path = self.__get_history_path()
+        if not history_path.exists():
+            return {}
+        try:
+            with open(history_path.as_posix(), 'r') as fh:
+                return json.load(fh)
+        except Exception:
+            self.logger.log(logging.ERROR, "Could not read history file %s. Starting with empty history", history_path.as_posix())
+            return {}
+
+    def __save_history(self):
+        history_path = self.__get_history_path()
+        temp_path = history_path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            with open(temp_path.as_posix(), 'w') as fh:
+                json.dump(self.history, fh, indent=1)
+            os.replace(temp_path.as_posix(), history_path.as_posix())
+        except Exception:
+            self.logger.log(logging.ERROR, "Could not write history file %s", history_path.as_posix())
+
+    @staticmethod
+    def __history_key(task: NgTask) -> str:
+        return f"{task.name}_{task.uid}"
+
+    def record(self, task: NgTask, interval: Interval, duration: float, transferred: int):
+        """Records duration (seconds) and transferred bytes of a completed run"""
+        with self.__lock:
+            # Other NgMain instances may have recorded runs since the history was loaded
+            self.history = self.__load_history()
+            runs = self.history.setdefault(self.__history_key(task), {}).setdefault(interval.name, [])
+            runs.append([round(duration, 1), int(transferred)])
+            del runs[:-self.history_size]
+            self.__save_history()
+
+    def expected_duration(self, task: NgTask, intervals: list[Interval]) -> float:
+        """Returns the expected run time of the given intervals of a task in seconds.
+
+        Intervals that have never run are estimated with the average of the
+        intervals of the task that have.
+        """
+        task_history = self.history.get(self.__history_key(task), {})
+        known: list[float] = []
+        unknown = 0
+        for interval in intervals:
+            runs = task_history.get(interval.name)
+            if runs:
+                known.append(sum(run[0] for run in runs) / len(runs))
+            else:
+                unknown = unknown + 1
+        if not known:
+            return 0.0
+        return sum(known) + unknown * (sum(known) / len(known))
+    # endregion
+
+    # region Planning
+    def get_deadline(self, now: float) -> float:
+        """Returns the end of the run window containing now as timestamp
+
+        Returns:
+            float: None if no window is set, 0 if now is outside the window
+        """
+        if not self.window:
+            return None
+        try:
+            start_time, end_time = self.window.split('-')
+            start_hour, start_minute = [int(value) for value in start_time.split(':')]
+            end_hour, end_minute = [int(value) for value in end_time.split(':')]
+        except ValueError:
+            self.logger.log(logging.ERROR, "Invalid run window %s. Expected HH:MM-HH:MM", self.window)
+            return None
+        current = datetime.fromtimestamp(now)
+        minutes = current.hour * 60 + current.minute
+        start = start_hour * 60 + start_minute
+        end = end_hour * 60 + end_minute
+        if start <= end:
+            inside = start <= minutes < end
+        else:
+            # Window across midnight
+            inside = minutes >= start or minutes < end
+        if not inside:
+            return 0
+        deadline = current.replace(hour=end_hour, minute=end_minute, second=0, microsecond=0)
+        if deadline <= current:
+            deadline = deadline + timedelta(days=1)
+        return deadline.timestamp()
+
+    def plan(self, work: list[tuple[NgTask, list[Interval]]]) -> list[tuple[NgTask, list[Interval], float]]:
+        """Orders the work by priority, then longest expected duration first"""
+        planned = [(task, intervals, self.expected_duration(task, intervals)) for task, intervals in work]
+        planned.sort(key=lambda item: (-self.priorities.get(item[0].name, 0), -item[2]))
+        for task, intervals, expected in planned:
+            self.logger.log(logging.INFO, "Planned Task: %s Priority: %d Intervals: %s Expected: %.0fs", task.name, self.priorities.get(task.name, 0), ','.join(interval.name for interval in intervals), expected)
+        return planned
+
+    def dispatch(self, work: list[tuple[NgTask, list[Interval]]], runner: Callable[[NgTask, list[Interval]], None], deferred: Callable[[NgTask, list[Interval], str], None] = None):
+        """Runs the planned work on up to max_threads threads
+
+        Args:
+            work (list[tuple[NgTask, list[Interval]]]): Tasks with the intervals due
+            runner (Callable[[NgTask, list[Interval]], None]): Called for each task that is started
+            deferred (Callable[[NgTask, list[Interval], str], None], optional): Called with the reason for each task deferred because it does not fit before the end of the run window. Defaults to None.
+        """
+        planned = self.plan(work)
+        deadline = self.get_deadline(time.time())
+        queue_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with queue_lock:
+                    if not planned:
+                        return
+                    task, intervals, expected = planned.pop(0)
+                now = time.time()
+                if deadline == 0:
+                    # Configured behavior, not reported
+                    self.logger.log(logging.INFO, "Deferring Task: %s. Outside of run window %s", task.name, self.window)
+                    continue
+                if deadline and now + expected > deadline:
+                    reason = f"Expected duration {expected:.0f}s does not fit before the end of run window {self.window}"
+                    self.logger.log(logging.WARNING, "Deferring Task: %s. %s", task.name, reason)
+                    if deferred:
+                        deferred(task, intervals, reason)
+                    continue
+                try:
+                    runner(task, intervals)
+                except Exception as ex:
+                    self.logger.log(logging.ERROR, "Task %s failed: %s", task.name, ex)
+
+        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            for i in range(min(self.max_threads, len(planned))):
+                executor.submit(worker)
+    # endregion
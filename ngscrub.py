@@ -0,0 +1,211 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from interval import Interval
+from ngtask import NgTask
+from pathlib import Path
+import hashlib
+import logging
+import os
+import sqlite3
+import stat
+import time
+
+class NgScrub:
+    """Verifies that the increments of a task are still readable and intact.
+
+    Increments are hard linked to each other, so the same inode shows up in
+    many increments. Every unique (device, inode) is hashed only once per
+    scrub and the hash is cached in a persistent store keyed by inode, mtime
+    and size. Later scrubs only hash inodes that are not in the cache, unless
+    verify is requested, in which case cached hashes are re-computed and
+    compared.
+
+    For tasks with a chunk store the chunks in <dest>/.chunks are scrubbed
+    too, each against the SHA-256 digest it is named after, so a corrupt
+    chunk is reported with every manifest that uses it instead of being
+    found at restore time.
+    """
+    task: NgTask
+    intervals: dict[str, Interval]
+    threads: int
+    verify: bool
+    logger: logging.Logger
+
+    read_size: int = 1048576
+
+    def __init__(self, task: NgTask, intervals: dict[str, Interval], threads: int = 4, verify: bool = False) -> None:
+        self.task = task
+        self.intervals = intervals
+        self.threads = max(1, int(threads))
+        self.verify = verify
+        self.logger = logging.getLogger(f"NgBackup.Scrub.{task.name}")
+
+    # region Hash cache
+    def __get_cache_path(self) -> Path:
+        current_directory = Path(os.getcwd())
+        return current_directory / "control" / f"scrub_{self.task.name}_{self.task.uid}.db"
+
+    def __open_cache(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.__get_cache_path().as_posix())
+        db.execute("CREATE TABLE IF NOT EXISTS hashes (inode INTEGER, mtime INTEGER, size INTEGER, digest TEXT, checked INTEGER, PRIMARY KEY (inode, mtime, size))")
+        return db
+
+    @staticmethod
+    def __get_cached_digest(db: sqlite3.Connection, st: os.stat_result) -> str:
+        row = db.execute("SELECT digest FROM hashes WHERE inode = ? AND mtime = ? AND size = ?", (st.st_ino, st.st_mtime_ns, st.st_size)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    @staticmethod
+    def __set_cached_digest(db: sqlite3.Connection, st: os.stat_result, digest: str):
+        db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", (st.st_ino, st.st_mtime_ns, st.st_size, digest, int(time.time())))
+    # endregion
+
+    # region Walk helpers
+    def __get_increment_paths(self) -> list[Path]:
+        dest_path = Path(self.task.dest_path.as_posix())
+        increment_paths: list[Path] = []
+        for interval_name in self.intervals.keys():
+            interval_path = dest_path / interval_name
+            if not interval_path.exists():
+                continue
+            for increment_path in sorted(interval_path.glob('*')):
+                if increment_path.name.endswith("_temp") or not increment_path.is_dir():
+                    continue
+                increment_paths.append(increment_path)
+        return increment_paths
+
+    def __walk_files(self, increment_path: Path):
+        """Yields (path, stat) for every regular file in the increment"""
+        for root, dirs, files in os.walk(increment_path.as_posix()):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                except OSError as ex:
+                    self.logger.log(logging.ERROR, "Could not stat %s: %s", path, ex)
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    yield path, st
+
+    def __walk_chunks(self):
+        """Yields (path, stat, digest) for every chunk in the chunk store of the task"""
+        for digest, chunk_path in self.task.chunk_store.list_chunks():
+            try:
+                st = os.lstat(chunk_path.as_posix())
+            except OSError as ex:
+                self.logger.log(logging.ERROR, "Could not stat %s: %s", chunk_path.as_posix(), ex)
+                continue
+            yield chunk_path.as_posix(), st, digest
+    # endregion
+
+    def __hash_file(self, path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            while True:
+                block = fh.read(self.read_size)
+                if not block:
+                    break
+                digest.update(block)
+        return digest.hexdigest()
+
+    def run(self) -> dict[str, list[str]]:
+        """Scrubs all increments of the task
+
+        Returns:
+            dict[str, list[str]]: Corrupt paths grouped by increment path
+        """
+        if self.task.dest_remote:
+            self.logger.log(logging.WARNING, "Scrub is only supported for local destinations. Skipping %s", self.task.dest_uri)
+            return {}
+
+        increment_paths = self.__get_increment_paths()
+        self.logger.log(logging.INFO, "Scrubbing %d increments with %d threads", len(increment_paths), self.threads)
+
+        db = self.__open_cache()
+        seen: set[tuple[int, int]] = set()
+        failures: dict[tuple[int, int], str] = {}
+        hashed = 0
+        cached = 0
+        max_pending = self.threads * 4
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            pending = {}
+
+            def collect(done):
+                nonlocal hashed
+                for future in done:
+                    path, st, expected, chunk_digest = pending.pop(future)
+                    key = (st.st_dev, st.st_ino)
+                    try:
+                        digest = future.result()
+                    except OSError as ex:
+                        failures[key] = f"read error: {ex}"
+                        continue
+                    hashed = hashed + 1
+                    if chunk_digest and chunk_digest != digest:
+                        failures[key] = f"chunk checksum mismatch: expected {chunk_digest} found {digest}"
+                    elif expected and expected != digest:
+                        failures[key] = f"checksum mismatch: expected {expected} found {digest}"
+                    else:
+                        self.__set_cached_digest(db, st, digest)
+
+            def submit(path: str, st: os.stat_result, chunk_digest: str = None):
+                nonlocal cached
+                key = (st.st_dev, st.st_ino)
+                if key in seen:
+                    return
+                seen.add(key)
+                expected = self.__get_cached_digest(db, st)
+                # A chunk is checked against its name, a cached hash that differs from it is stale
+                if expected and not self.verify and (not chunk_digest or expected == chunk_digest):
+                    cached = cached + 1
+                    return
+                if len(pending) >= max_pending:
+                    done, not_done = wait(pending.keys(), return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending[executor.submit(self.__hash_file, path)] = (path, st, expected, chunk_digest)
+
+            for increment_path in increment_paths:
+                for path, st in self.__walk_files(increment_path):
+                    submit(path, st)
+                db.commit()
+            if self.task.chunked:
+                self.logger.log(logging.INFO, "Scrubbing chunk store %s", self.task.chunk_store.store_path.as_posix())
+                for path, st, digest in self.__walk_chunks():
+                    submit(path, st, digest)
+
+            done, not_done = wait(pending.keys())
+            collect(done)
+
+        db.commit()
+        db.close()
+        self.logger.log(logging.INFO, "Scrub completed. Unique inodes: %d Hashed: %d Cached: %d Corrupt: %d", len(seen), hashed, cached, len(failures))
+
+        return self.__report(increment_paths, failures)
+
+    def __report(self, increment_paths: list[Path], failures: dict[tuple[int, int], str]) -> dict[str, list[str]]:
+        """Maps corrupt inodes back to every increment and path that links to them, corrupt chunks to the manifests using them"""
+        report: dict[str, list[str]] = {}
+        if not failures:
+            return report
+        corrupt_chunks: dict[str, str] = {}
+        if self.task.chunked:
+            for path, st, digest in self.__walk_chunks():
+                reason = failures.get((st.st_dev, st.st_ino))
+                if reason:
+                    corrupt_chunks[digest] = reason
+                    report.setdefault(self.task.chunk_store.store_path.as_posix(), []).append(path)
+                    self.logger.log(logging.ERROR, "Corrupt chunk %s: %s", path, reason)
+        for increment_path in increment_paths:
+            for path, st in self.__walk_files(increment_path):
+                reason = failures.get((st.st_dev, st.st_ino))
+                if not reason and corrupt_chunks and path.endswith(self.task.chunk_store.manifest_suffix):
+                    manifest = self.task.chunk_store.read_manifest(Path(path)) or {}
+                    reason = next((f"uses corrupt chunk {digest}" for digest, length in manifest.get("chunks", []) if digest in corrupt_chunks), None)
+                if reason:
+                    report.setdefault(increment_path.as_posix(), []).append(path)
+                    self.logger.log(logging.ERROR, "Corrupt file %s: %s", path, reason)
+        for increment, paths in report.items():
+            self.logger.log(logging.ERROR, "Increment %s has %d corrupt files", increment, len(paths))
+        return report
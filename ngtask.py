@@ -1,4 +1,8 @@
+from ngchunk import NgChunkStore
+from ngfilter import NgFilter
+from ngindex import NgIncrementIndex
 from ngremote import NgRemote
+from ngthrottle import NgThrottle
 from interval import Interval
 from ngutil import NgUtil
 from pathlib import Path, PureWindowsPath
@@ -6,6 +10,7 @@ import logging
 from uriparser import UriParser
 import hashlib
 import os
+import re
 import time
 import subprocess
 
@@ -30,8 +35,18 @@ class NgTask:
 
     ssh_bin: Path
     rsync_bin: Path
+    ssh_port: int = 22
+    ssh_options: str = ''
+    connect_timeout: float = 10
+    chunk_threshold: int = 0
+    filter: NgFilter = None
+    throttle: NgThrottle = None
+    __chunk_store: NgChunkStore = None
+    __increment_index: NgIncrementIndex = None
 
     notifications: dict[str, list] = {}
+    fanout: list['NgTask']
+    transferred_bytes: int = 0
     
     def __init__(self, name: str, src: str, dest: str, rsync_options: str) -> None:
         self.name = name
@@ -40,6 +55,8 @@ class NgTask:
         self.dest_uri = dest
         self.dest_user, self.dest_host, self.dest_path = UriParser(dest).values()
         self.rsync_options = rsync_options
+        self.notifications = {}
+        self.fanout = []
         self.logger = logging.getLogger(f"NgBackup.Task.{self.name}")
         self.logger.log(logging.INFO, "Initialized NgTask Name: %s UID: %s", self.name, self.uid)
     
@@ -91,6 +108,36 @@ class NgTask:
         hash_object = hashlib.md5(str_hash.encode())
         return hash_object.hexdigest()
 
+    @property
+    def remote_host(self) -> str:
+        if self.src_remote:
+            return self.src_host
+        elif self.dest_remote:
+            return self.dest_host
+        return None
+
+    @property
+    def chunked(self) -> bool:
+        """Files larger than chunk_threshold go to the chunk store. Local source and destination only"""
+        if self.chunk_threshold > 0 and not self.src_remote and not self.dest_remote:
+            return True
+        return False
+
+    @property
+    def chunk_store(self) -> NgChunkStore:
+        if not self.__chunk_store:
+            self.__chunk_store = NgChunkStore(self.dest_path)
+        return self.__chunk_store
+
+    @property
+    def increment_index(self) -> NgIncrementIndex:
+        if not self.__increment_index:
+            if self.dest_remote:
+                self.__increment_index = NgIncrementIndex(self.name, self.uid, self.__get_remote_mtime, self.__list_remote)
+            else:
+                self.__increment_index = NgIncrementIndex(self.name, self.uid, self.__get_local_mtime, self.__list_local)
+        return self.__increment_index
+
     def remote_alive(self) -> bool:
         return self.__ssh.check_status()
 
@@ -99,35 +146,38 @@ class NgTask:
     # region Platform specific backup helper methods
     def connect_remote(self):
         if self.src_remote:
-            self.__ssh = NgRemote(self.src_host, 22, self.src_user, self.src_key)
+            self.__ssh = NgRemote(self.src_host, self.ssh_port, self.src_user, self.src_key)
         elif self.dest_remote:
-            self.__ssh = NgRemote(self.dest_host, 22, self.dest_user, self.dest_key)            
+            self.__ssh = NgRemote(self.dest_host, self.ssh_port, self.dest_user, self.dest_key)            
         else:
             self.logger.log(logging.WARNING, "Source/Destination are not remote")
 
-        self.__ssh.connect()
+        self.__ssh.connect(self.connect_timeout)
  
     def close_remote(self):
-        if self.src_remote or self.dest_remote:
+        if (self.src_remote or self.dest_remote) and self.__ssh:
             self.__ssh.close()
     
     def __rotate_local_target(self, interval: Interval) -> bool:
         self.logger.log(logging.INFO, "Rotating local target for Interval: %s", interval.name)
         
         # Check if interval path exists. If not, we are running first time. 
-        interval_path = self.dest_path / interval.name        
-        if not interval_path.exists():
+        interval_path = Path((self.dest_path / interval.name).as_posix())
+        increment_names = self.increment_index.list(interval_path)
+        if increment_names is None:
             self.logger.log(logging.DEBUG, "Interval Path: %s does no exist. Nothing to rotate", interval_path.as_posix())
             return True
         
-        increment_paths = sorted(interval_path.glob('*'))
+        increment_paths = [interval_path / name for name in increment_names]
         if increment_paths and len(increment_paths) > interval.rotations:
             self.logger.log(logging.DEBUG, "Found %d increments in Interval Path: %s", len(increment_paths), interval_path.as_posix())
             count = len(increment_paths) - interval.rotations
             while count > 0:
                 trim_path = increment_paths[count - 1]
-                if NgUtil.rmtree(trim_path):
+                if self.increment_index.change(interval_path, lambda: NgUtil.rmtree(trim_path), remove=trim_path.name):
                     self.logger.log(logging.INFO, "Deleted %s increment %s", interval.name, trim_path)
+                    if self.chunked:
+                        self.chunk_store.release_increment(f"{interval.name}/{trim_path.name}")
                 else:
                     self.logger.log(logging.ERROR, "Could not delete %s increment %s", interval.name, trim_path)
                     return False
@@ -138,22 +188,27 @@ class NgTask:
     def __clean_local_target(self, interval: Interval):
         interval_path = self.dest_path / interval.name
         interval_path = Path(interval_path.as_posix())
-        temp_increment_paths = sorted(interval_path.glob('*_temp'))
+        increment_names = self.increment_index.list(interval_path) or []
+        temp_increment_paths = [interval_path / name for name in increment_names if name.endswith('_temp')]
         for path in temp_increment_paths:
-            if NgUtil.rmtree(path):
+            if self.increment_index.change(interval_path, lambda: NgUtil.rmtree(path), remove=path.name):
+                if self.chunked:
+                    # Chunks stored by the failed run
+                    self.chunk_store.release_increment(f"{interval.name}/{path.name}")
                 self.logger.log(logging.INFO, "Deleted temp folder %s", path.as_posix())
             else:
                 self.logger.log(logging.ERROR, "Could not delete temp folder %s", path.as_posix())
 
     def __clean_remote_target(self, interval: Interval):
         interval_path = self.dest_path / interval.name
-        if not self.__ssh.exists(interval_path):
+        increment_names = self.increment_index.list(interval_path)
+        if increment_names is None:
             return
-        increment_paths = self.__ssh.listdir(interval_path)        
+        increment_paths = [interval_path / name for name in increment_names]
         for path in increment_paths:
             name = path.name
             if "_temp" in name:
-                if self.__ssh.rmtree(path):
+                if self.increment_index.change(interval_path, lambda: self.__ssh.rmtree(path), remove=name):
                     self.logger.log(logging.INFO, "Deleted temp folder %s", path.as_posix())
                 else:
                     self.logger.log(logging.ERROR, "Failed to delte temp folder %s", path.as_posix())
@@ -163,17 +218,18 @@ class NgTask:
 
         # Check if interval path exists. If not, we are running first time. 
         interval_path = self.dest_path / interval.name
-        if not self.__ssh.exists(interval_path):
+        increment_names = self.increment_index.list(interval_path)
+        if increment_names is None:
             self.logger.log(logging.DEBUG, "Interval Path: %s does no exist. Nothing to rotate", interval_path.as_posix())
             return True        
 
-        increment_paths = self.__ssh.listdir(interval_path)        
+        increment_paths = [interval_path / name for name in increment_names]
         if increment_paths and len(increment_paths) > interval.rotations:
             self.logger.log(logging.DEBUG, "Found %d increments in Interval Path: %s. Will be trimmed to: %d", len(increment_paths), interval_path.as_posix(), interval.rotations)
             count = len(increment_paths) - interval.rotations
             while count > 0:
                 trim_path = increment_paths[count - 1]
-                if self.__ssh.rmtree(trim_path):
+                if self.increment_index.change(interval_path, lambda: self.__ssh.rmtree(trim_path), remove=trim_path.name):
                     self.logger.log(logging.INFO, "Deleted %s increment %s", interval.name, trim_path)
                 else:
                     self.logger.log(logging.ERROR, "Could not delete %s increment %s", interval.name, trim_path)
@@ -186,8 +242,10 @@ class NgTask:
         increment_path = Path(increment_path.as_posix())
         if not increment_path.exists(): # Sanity Check. Should not exist
             try:
-                increment_path.mkdir(parents=True, exist_ok=False)
-                return True
+                def mkdir() -> bool:
+                    increment_path.mkdir(parents=True, exist_ok=False)
+                    return True
+                return self.increment_index.change(increment_path.parent, mkdir, add=increment_name)
             except Exception:
                 self.logger.log(logging.ERROR, "Failed to create directory %s", increment_path.as_posix())
                 return False
@@ -199,7 +257,7 @@ class NgTask:
         self.logger.log(logging.INFO, "Preparing remote target for Interval: %s Increment Name: %s", interval.name, increment_name)
         increment_path = self.dest_path / interval.name / increment_name
         if not self.__ssh.exists(increment_path):
-            if self.__ssh.makedirs(increment_path):
+            if self.increment_index.change(increment_path.parent, lambda: self.__ssh.makedirs(increment_path), add=increment_name):
                 self.logger.log(logging.DEBUG, "Created remote directory %s", increment_path.as_posix())
                 return True
             else:
@@ -209,12 +267,12 @@ class NgTask:
     def __get_local_last_increment(self, interval: Interval) -> Path:
         interval_path = self.dest_path / f"{interval.name}"
         interval_path = Path(interval_path.as_posix())
-        if not interval_path.exists():
+        increments = self.increment_index.list(interval_path)
+        if increments is None:
             self.logger.log(logging.INFO, "Interval: %s path %s not found", interval.name ,interval_path.as_posix())
             return None
-        increments = sorted(interval_path.glob('*'))
         if increments and len(increments) > 0:            
-            return increments[len(increments) - 1]
+            return interval_path / increments[len(increments) - 1]
         else:
             return None
     
@@ -232,12 +290,9 @@ class NgTask:
 
     def __get_remote_last_increment(self, interval: Interval) -> Path:
         interval_path = self.dest_path / interval.name
-        if not self.__ssh.exists(interval_path):
-            return None
-
-        increments = self.__ssh.listdir(interval_path)
+        increments = self.increment_index.list(interval_path)
         if increments:
-            return increments[len(increments) -1]
+            return interval_path / increments[len(increments) -1]
     
     def __get_remote_link_dest(self, interval: Interval) -> Path:
         self.logger.log(logging.INFO, "Finding remote link dest for %s", interval.name)
@@ -252,14 +307,84 @@ class NgTask:
 
     def __rename_local_target(self, src_path: Path, dest_path: Path):
         try:
-            src_path.rename(dest_path)
-            return True
+            def rename() -> bool:
+                src_path.rename(dest_path)
+                return True
+            return self.increment_index.change(Path(src_path.parent.as_posix()), rename, remove=src_path.name, add=dest_path.name)
         except Exception as exception:
             self.logger.log(logging.ERROR, "Could not rename local target %s to %s", src_path.as_posix(), dest_path.as_posix())
             return False
 
+    def __get_local_mtime(self, path: Path) -> int:
+        try:
+            return os.stat(path.as_posix()).st_mtime_ns
+        except OSError:
+            return None
+
+    def __list_local(self, path: Path) -> list[str]:
+        try:
+            return os.listdir(path.as_posix())
+        except OSError:
+            self.logger.log(logging.ERROR, "Could not list %s", path.as_posix())
+            return None
+
+    def __get_remote_mtime(self, path: Path) -> int:
+        return self.__ssh.get_mtime(path)
+
+    def __list_remote(self, path: Path) -> list[str]:
+        increments = self.__ssh.listdir(path)
+        if increments is None:
+            return None
+        return [increment.name for increment in increments]
+
+    def __excluded(self, relative: Path, is_dir: bool) -> bool:
+        rule = self.filter.match(relative.as_posix(), is_dir)
+        if rule and rule.startswith('-'):
+            return True
+        return False
+
+    def __store_chunked_files(self, interval: Interval, temp_increment_path: Path, link_dest_path: Path) -> set[str]:
+        """Moves files larger than chunk_threshold into the chunk store, skipped by rsync with --max-size
+
+        Returns:
+            set[str]: Chunk digests referenced by the increment, None on failure
+        """
+        src_path = Path(self.src_path.as_posix())
+        temp_increment_path = Path(temp_increment_path.as_posix())
+        # rsync copies the source directory itself (no trailing slash) into the increment
+        large_files: list[tuple[Path, Path]] = []
+        if src_path.is_file():
+            if src_path.stat().st_size > self.chunk_threshold:
+                large_files.append((src_path, Path(src_path.name)))
+        else:
+            for root, dirs, files in os.walk(src_path.as_posix()):
+                relative_root = Path(src_path.name) / Path(root).relative_to(src_path)
+                if self.filter:
+                    # Skip what rsync excludes
+                    dirs[:] = [name for name in dirs if not self.__excluded(relative_root / name, True)]
+                for name in files:
+                    path = Path(root) / name
+                    if self.filter and self.__excluded(relative_root / name, False):
+                        continue
+                    if not path.is_symlink() and path.stat().st_size > self.chunk_threshold:
+                        large_files.append((path, relative_root / name))
+
+        digests: set[str] = set()
+        for path, relative in large_files:
+            manifest_name = f"{relative.as_posix()}{NgChunkStore.manifest_suffix}"
+            previous_manifest_path = None
+            if link_dest_path:
+                previous_manifest_path = Path(link_dest_path.as_posix()) / manifest_name
+            try:
+                digests.update(self.chunk_store.store_file(f"{interval.name}/{temp_increment_path.name}", path, temp_increment_path / manifest_name, previous_manifest_path))
+            except Exception as ex:
+                self.logger.log(logging.ERROR, "Could not store %s in chunk store: %s", path.as_posix(), ex)
+                return None
+        self.logger.log(logging.INFO, "Stored %d large files as %d chunks", len(large_files), len(digests))
+        return digests
+
     def __rename_remote_target(self, src_path: Path, dest_path: Path):
-        if self.__ssh.rename(src_path, dest_path):
+        if self.increment_index.change(src_path.parent, lambda: self.__ssh.rename(src_path, dest_path), remove=src_path.name, add=dest_path.name):
             return True
         else:
             return False
@@ -344,22 +469,73 @@ class NgTask:
         else:
             return self.__rename_local_target(src_path, dest_path)
     
-    def build_rsync_command(self, interval: Interval, increment_name: str, temp_increment_name: str):
-        cmd = f"{self.rsync_bin} -a {self.rsync_options}"            
+    def __parse_transferred_bytes(self, output: str) -> int:
+        match = re.search(r"Total transferred file size: ([0-9,.]+) bytes", output)
+        if match:
+            try:
+                return int(match.group(1).replace(',', '').replace('.', ''))
+            except ValueError:
+                pass
+        return 0
+
+    def __get_ssh_command(self, key: Path) -> str:
+        ssh_cmd = f"{self.ssh_bin} -i {key.as_posix()}"
+        if self.ssh_port != 22:
+            ssh_cmd = f"{ssh_cmd} -p {self.ssh_port}"
+        if self.ssh_options:
+            ssh_cmd = f"{ssh_cmd} {self.ssh_options}"
+        return ssh_cmd
+
+    def __get_filter_file_path(self) -> Path:
+        filter_directory = Path(os.getcwd()) / "control" / "filters"
+        if not filter_directory.exists():
+            filter_directory.mkdir(parents=True, exist_ok=True)
+        return filter_directory / f"{self.name}_{self.uid}.rules"
+
+    def __get_batch_file_path(self, interval: Interval) -> Path:
+        batch_directory = Path(os.getcwd()) / "control" / "batch"
+        if not batch_directory.exists():
+            batch_directory.mkdir(parents=True, exist_ok=True)
+        return batch_directory / f"{self.name}_{self.uid}_{interval.name}"
+
+    def build_rsync_command(self, interval: Interval, increment_name: str, temp_increment_name: str, write_batch: Path = None, read_batch: Path = None, source: str = None, link_dest_path: Path = None):
+        cmd = f"{self.rsync_bin} -a --stats {self.rsync_options}"            
+
+        # Include/exclude rules
+        if self.filter and self.filter.rules:
+            filter_path = self.__get_filter_file_path()
+            if self.filter.write(filter_path):
+                cmd = f"{cmd} --filter=\"merge {NgUtil.normalize_path(filter_path)}\""
+
+        # Record the transfer for the fan-out destinations, or replay a recorded one
+        if write_batch:
+            cmd = f"{cmd} --write-batch={NgUtil.normalize_path(write_batch)}"
+        if read_batch:
+            cmd = f"{cmd} --read-batch={NgUtil.normalize_path(read_batch)}"
+        
+        # Bandwidth limit, progress stream and remote I/O priority of the throttle
+        if self.throttle:
+            remote_rsync = (self.src_remote or self.dest_remote) and "--rsync-path" not in self.rsync_options
+            cmd = f"{cmd} {self.throttle.get_rsync_options(remote_rsync)}"
+
+        # Large files are stored in the chunk store instead
+        if self.chunked:
+            cmd = f"{cmd} --max-size={self.chunk_threshold}"
         
 
         # Add ssh key if need
         if self.src_remote:
-            cmd = f"{cmd} -e \"{self.ssh_bin} -i {self.src_key.as_posix()}\""
+            cmd = f"{cmd} -e \"{self.__get_ssh_command(self.src_key)}\""
         if self.dest_remote:
-            cmd = f"{cmd} -e \"{self.ssh_bin} -i {self.dest_key.as_posix()}\""
+            cmd = f"{cmd} -e \"{self.__get_ssh_command(self.dest_key)}\""
         
         # Append log-file
         log_file_path = self.__get_log_file_path(interval, increment_name)
         cmd = f"{cmd} --log-file={log_file_path.as_posix()}"
 
         # Append link-dest        
-        link_dest_path = self.__get_link_dest_path(interval)        
+        if not link_dest_path:
+            link_dest_path = self.__get_link_dest_path(interval)        
         if link_dest_path:
             self.logger.log(logging.DEBUG, "Link Dest Path: %s", link_dest_path.as_posix())        
             if link_dest_path.drive:
@@ -367,37 +543,105 @@ class NgTask:
             else:
                 cmd = f"{cmd} --link-dest={link_dest_path.as_posix()}"
 
-        # Append source and destination
-        rsync_cmd = f"{cmd} {self.rsync_src_uri} {self.rsync_dest_uri}/{interval.name}/{temp_increment_name}"
+        # Append source and destination. A batch replay reads the source from the batch file
+        if read_batch:
+            rsync_cmd = f"{cmd} {self.rsync_dest_uri}/{interval.name}/{temp_increment_name}"
+        else:
+            rsync_cmd = f"{cmd} {source or self.rsync_src_uri} {self.rsync_dest_uri}/{interval.name}/{temp_increment_name}"
 
         return rsync_cmd
     
     # endregion
 
     # region Backup
-    def synchronize(self, interval: Interval):
+    def synchronize(self, interval: Interval, fanout: list['NgTask'] = None) -> dict[str, bool]:
+        """Synchronizes this destination and the given fan-out destinations
+
+        The source is scanned and diffed once for this destination and the
+        rsync batch is replayed to the fan-out destinations. Any destination
+        of the task can act as the one writing the batch.
+
+        Returns:
+            dict[str, bool]: Status per destination (task name)
+        """
+        if not fanout:
+            return {self.name: self.__synchronize_increment(interval)}
+
+        batch_path = self.__get_batch_file_path(interval)
+        status = {self.name: self.__synchronize_increment(interval, write_batch=batch_path)}
+        for destination in fanout:
+            if status[self.name] and destination.chunked == self.chunked:
+                status[destination.name] = destination.replay_batch(interval, batch_path)
+            else:
+                status[destination.name] = destination.replay_batch(interval, None)
+        for path in (batch_path, batch_path.with_name(f"{batch_path.name}.sh")):
+            if path.exists():
+                path.unlink()
+        return status
+
+    def replay_batch(self, interval: Interval, batch_path: Path) -> bool:
+        """Applies a batch written by the primary destination. Falls back to a full synchronize"""
+        if batch_path:
+            if self.__synchronize_increment(interval, read_batch=batch_path):
+                return True
+            self.logger.log(logging.WARNING, "Replaying batch %s failed. Destination differs from the primary. Running full %s backup", batch_path.as_posix(), interval.name)
+        return self.__synchronize_increment(interval)
+
+    def replicate_increment(self, interval: Interval, increment_name: str, src_path: Path, link_dest_name: str = None) -> bool:
+        """Copies a finished increment of another (local) destination to this destination under the same name
+
+        Args:
+            interval (Interval): Interval of the increment. Rotations apply to this destination
+            increment_name (str): Name of the increment
+            src_path (Path): Local path of the increment to copy
+            link_dest_name (str, optional): Previously replicated increment used as link-dest. Defaults to the last increment.
+        """
+        link_dest_path = None
+        if link_dest_name:
+            link_dest_path = self.dest_path / interval.name / link_dest_name
+        source = f"{NgUtil.normalize_path(src_path)}/"
+        return self.__synchronize_increment(interval, increment_name=increment_name, source=source, link_dest_path=link_dest_path)
+
+    def __synchronize_increment(self, interval: Interval, write_batch: Path = None, read_batch: Path = None, increment_name: str = None, source: str = None, link_dest_path: Path = None) -> bool:
+        self.transferred_bytes = 0
         if self.src_remote or self.dest_remote:
-            status = self.__ssh.check_status()
-            if not status:
-                return
+            if not self.__ssh or not self.__ssh.check_status():
+                self.logger.log(logging.ERROR, "Not connected to %s", self.remote_host)
+                return False
         
         self.logger.log(logging.INFO, "Running incremental backup for Interval: %s", interval.name)        
-        increment_name = interval.get_increment_name()
+        if not increment_name:
+            increment_name = interval.get_increment_name()
         increment_path = self.dest_path / interval.name / increment_name
         temp_increment_name = f"{increment_name}_temp"
         temp_increment_path = self.dest_path / interval.name / temp_increment_name
         self.__clean_target(interval)
-        rsync_cmd = self.build_rsync_command(interval, increment_name, temp_increment_name)
+        rsync_cmd = self.build_rsync_command(interval, increment_name, temp_increment_name, write_batch, read_batch, source, link_dest_path)
         self.logger.log(logging.DEBUG, "Rsync Command: %s", rsync_cmd)
+        if self.chunked and not link_dest_path:
+            link_dest_path = self.__get_link_dest_path(interval)
         self.__prepare_target(interval, temp_increment_name)
         try:
-            result = subprocess.run(rsync_cmd, capture_output=True, shell=True)
+            if self.throttle:
+                result = self.throttle.run(rsync_cmd, self.__ssh.get_latency if self.__ssh else None)
+            else:
+                result = subprocess.run(rsync_cmd, capture_output=True, shell=True)
             if result.returncode == 0:
                 self.logger.log(logging.INFO, "Successfully completed %s backup of %s", interval.name, self.name)
+                self.transferred_bytes = self.__parse_transferred_bytes(result.stdout.decode('utf8', errors='replace'))
+                chunk_digests = None
+                if self.chunked:
+                    chunk_digests = self.__store_chunked_files(interval, temp_increment_path, link_dest_path)
+                    if chunk_digests is None:
+                        self.logger.log(logging.ERROR, "Failed to store large files of %s backup of %s", interval.name, self.name)
+                        return False
                 if self.__rename_target(temp_increment_path, increment_path):
                     self.logger.log(logging.DEBUG, "Successfully renamed %s to %s", temp_increment_path.as_posix(), increment_path.as_posix())
+                    if self.chunked:
+                        self.chunk_store.rename_increment(f"{interval.name}/{temp_increment_name}", f"{interval.name}/{increment_name}")
                     self.__rotate_target(interval)
                     self.__set_last_run(interval)
+                    return True
             else:
                 self.logger.log(logging.INFO, "Failed to complete %s backup of %s", interval.name, self.name)
         except Exception as ex:
@@ -406,5 +650,6 @@ class NgTask:
             self.logger.log(logging.ERROR, ex)
             self.logger.log(logging.ERROR, "Stdout: %s", str_out)
             self.logger.log(logging.ERROR, "Stderr: %s", str_err)
+        return False
 
     # endregion
\ No newline at end of file
@@ -0,0 +1,325 @@
+from datetime import datetime
+from ngutil import NgUtil
+from typing import Callable
+import logging
+import psutil
+import re
+import subprocess
+import sys
+import threading
+import time
+
+class NgThrottle:
+    """Time of day bandwidth and I/O priority controller for rsync processes.
+
+    One controller is shared by all transfers to the same destination host
+    (or task), which split the bandwidth of the current time window between
+    them. Pacing is left to rsync: it starts with --bwlimit set to its share
+    of the current window. When the share moves by more than restart_margin
+    while rsync runs, because another window begins, transfers to the host
+    start or finish, or the round trip time to the host rises well above
+    the lowest one seen (the uplink is queueing), rsync is stopped and
+    started again with the new --bwlimit. Restarts are at least
+    restart_interval seconds apart; rsync skips the files it already
+    copied and continues a partial file (--partial). Batch transfers
+    (--write-batch/--read-batch) are not restarted and keep their limit.
+
+    Rising latency halves the limit of the host, down to min_limit, and it
+    recovers gradually. A transfer whose progress stalls for stall_timeout
+    seconds while it was running at its limit only backs off itself. Quiet
+    periods while rsync builds the file list or checks unchanged files are
+    not congestion.
+
+    The I/O priority applies to the local rsync processes (ionice, nice
+    where ionice is unavailable) and, through --rsync-path, to the rsync on
+    a remote host, which needs ionice there.
+    """
+    name: str
+    schedule: list[tuple[int, int, int]]
+    io_schedule: list[tuple[int, int, str]]
+    min_limit: int
+    interval: float = 0.5
+    window: float = 5
+    stall_timeout: float = 10
+    saturation: float = 0.8
+    restart_margin: float = 0.25
+    restart_interval: float = 300
+    latency_interval: float = 5
+    latency_factor: float = 2
+    latency_margin: float = 0.05
+    logger: logging.Logger
+
+    remote_io_commands: dict[str, str] = {"idle": "ionice -c3", "low": "ionice -c2 -n7"}
+
+    progress_expr = re.compile(r"^\s*([0-9,.]+)\s+\d+%")
+    bwlimit_expr = re.compile(r"--bwlimit[= ]([0-9]+)")
+    window_expr = re.compile(r"(?P<start>\d{1,2}:\d{2})-(?P<end>\d{1,2}:\d{2})=(?P<value>\S+)")
+
+    def __init__(self, name: str, schedule: str = '', io_schedule: str = '', min_limit: int = 65536) -> None:
+        """Initializes the controller
+
+        Args:
+            name (str): Task or host the controller applies to
+            schedule (str, optional): "HH:MM-HH:MM=limit ..." in bytes per second (K, M suffix), 0 for unlimited. Defaults to ''.
+            io_schedule (str, optional): "HH:MM-HH:MM=idle|low|normal ...". Defaults to ''.
+            min_limit (int, optional): Lowest limit the controller backs off to. Defaults to 65536.
+        """
+        self.name = name
+        self.min_limit = min_limit
+        self.logger = logging.getLogger(f"NgBackup.Throttle.{name}")
+        self.schedule = [(start, end, NgUtil.parse_size(value) or 0) for start, end, value in self.__parse_windows(schedule)]
+        self.io_schedule = [(start, end, value.lower()) for start, end, value in self.__parse_windows(io_schedule)]
+        self.__lock = threading.Lock()
+        self.__active = 0
+        self.__factor = 1.0
+        self.__base_latency: float = None
+
+    def __parse_windows(self, schedule: str) -> list[tuple[int, int, str]]:
+        windows: list[tuple[int, int, str]] = []
+        for value in schedule.strip('"').split():
+            match = self.window_expr.fullmatch(value)
+            if not match:
+                self.logger.log(logging.ERROR, "Invalid schedule window %s. Expected HH:MM-HH:MM=value", value)
+                continue
+            start = self.__minutes(match.group("start"))
+            end = self.__minutes(match.group("end"))
+            windows.append((start, end, match.group("value")))
+        return windows
+
+    @staticmethod
+    def __minutes(str_time: str) -> int:
+        hour, minute = str_time.split(':')
+        return int(hour) * 60 + int(minute)
+
+    @staticmethod
+    def __lookup(windows: list[tuple], now: float):
+        current = datetime.fromtimestamp(now)
+        minutes = current.hour * 60 + current.minute
+        for start, end, value in windows:
+            if start <= end and start <= minutes < end:
+                return value
+            # Window across midnight
+            if start > end and (minutes >= start or minutes < end):
+                return value
+        return None
+
+    def get_limit(self, now: float = None) -> int:
+        """Returns the scheduled limit in bytes per second for now, 0 if unlimited"""
+        return self.__lookup(self.schedule, now or time.time()) or 0
+
+    def get_io_priority(self, now: float = None) -> str:
+        return self.__lookup(self.io_schedule, now or time.time()) or "normal"
+
+    def get_rsync_options(self, remote_rsync: bool = False, now: float = None) -> str:
+        """Returns the options for an rsync started now
+
+        Args:
+            remote_rsync (bool, optional): Set the I/O priority of the rsync on the remote host. Defaults to False.
+            now (float, optional): Defaults to the current time.
+        """
+        options = "--info=progress2"
+        if self.schedule:
+            # Keeps the partial file when rsync is restarted with a new limit
+            options = f"{options} --partial"
+        bwlimit = self.get_share(now=now)
+        if bwlimit:
+            options = f"{options} --bwlimit={bwlimit}"
+        command = self.remote_io_commands.get(self.get_io_priority(now))
+        if remote_rsync and command:
+            options = f"{options} --rsync-path=\"{command} rsync\""
+        return options
+
+    def get_share(self, factor: float = 1.0, transfers: int = None, now: float = None) -> int:
+        """Returns the --bwlimit of one transfer in units of 1024 bytes per second, 0 if unlimited
+
+        Args:
+            factor (float, optional): Back-off of the transfer itself. Defaults to 1.0.
+            transfers (int, optional): Transfers sharing the limit. Defaults to the running ones and a new one.
+            now (float, optional): Defaults to the current time.
+        """
+        limit = self.get_limit(now)
+        if not limit:
+            return 0
+        with self.__lock:
+            if transfers is None:
+                transfers = self.__active + 1
+            share = max(self.min_limit, limit * self.__factor * factor) / max(1, transfers)
+        return max(1, int(share) // 1024)
+
+    # region Process control
+    @staticmethod
+    def __get_processes(process: subprocess.Popen) -> list[psutil.Process]:
+        try:
+            parent = psutil.Process(process.pid)
+            return [parent] + parent.children(recursive=True)
+        except psutil.Error:
+            return []
+
+    def __set_io_priority(self, process: subprocess.Popen, priority: str):
+        for p in self.__get_processes(process):
+            try:
+                if sys.platform == 'win32':
+                    values = {"idle": psutil.IOPRIO_VERYLOW, "low": psutil.IOPRIO_LOW, "normal": psutil.IOPRIO_NORMAL}
+                    p.ionice(values.get(priority, psutil.IOPRIO_NORMAL))
+                elif hasattr(p, "ionice"):
+                    values = {"idle": psutil.IOPRIO_CLASS_IDLE, "low": psutil.IOPRIO_CLASS_BE, "normal": psutil.IOPRIO_CLASS_NONE}
+                    p.ionice(values.get(priority, psutil.IOPRIO_CLASS_NONE), 7 if priority == "low" else 0)
+                else:
+                    p.nice(19 if priority in ("idle", "low") else 0)
+            except (psutil.Error, OSError, ValueError):
+                pass
+
+    def __stop(self, process: subprocess.Popen):
+        processes = self.__get_processes(process)
+        for p in processes:
+            try:
+                p.terminate()
+            except psutil.Error:
+                pass
+        gone, alive = psutil.wait_procs(processes, timeout=10)
+        for p in alive:
+            try:
+                p.kill()
+            except psutil.Error:
+                pass
+        process.wait()
+
+    def __start(self, cmd: str, stdout: list[bytes], stderr: list[bytes], state: dict) -> tuple[subprocess.Popen, list[threading.Thread]]:
+        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def read_stdout():
+            pending = b''
+            for data in iter(lambda: process.stdout.read1(65536), b''):
+                stdout.append(data)
+                lines = re.split(rb"[\r\n]", pending + data)
+                pending = lines.pop()
+                for line in lines:
+                    match = self.progress_expr.match(line.decode('utf8', errors='replace'))
+                    if match:
+                        state["bytes"] = int(re.sub(r"[,.]", "", match.group(1)))
+                        state["progress_time"] = time.time()
+
+        def read_stderr():
+            for data in iter(lambda: process.stderr.read1(65536), b''):
+                stderr.append(data)
+
+        readers = [threading.Thread(target=read_stdout, daemon=True), threading.Thread(target=read_stderr, daemon=True)]
+        for reader in readers:
+            reader.start()
+        return process, readers
+    # endregion
+
+    def run(self, cmd: str, latency: Callable[[], float] = None) -> subprocess.CompletedProcess:
+        """Runs the rsync command (built with get_rsync_options) under the controller
+
+        Args:
+            cmd (str): rsync command
+            latency (Callable[[], float], optional): Returns the round trip time to the remote host in seconds, None if unknown. Defaults to None.
+        """
+        stdout: list[bytes] = []
+        stderr: list[bytes] = []
+        state = {"bytes": 0, "progress_time": time.time(), "latency": None, "running": True}
+        restartable = "--write-batch" not in cmd and "--read-batch" not in cmd
+
+        def sample_latency():
+            # Runs apart from the control loop, a slow round trip must not hold back the control
+            while state["running"]:
+                state["latency"] = latency()
+                time.sleep(self.latency_interval)
+
+        if latency:
+            threading.Thread(target=sample_latency, daemon=True).start()
+        with self.__lock:
+            self.__active = self.__active + 1
+        try:
+            while True:
+                match = self.bwlimit_expr.search(cmd)
+                bwlimit = int(match.group(1)) if match else 0
+                state["bytes"] = 0
+                state["progress_time"] = time.time()
+                process, readers = self.__start(cmd, stdout, stderr, state)
+                new_bwlimit = self.__control(process, state, bwlimit, restartable)
+                for reader in readers:
+                    reader.join()
+                if new_bwlimit is None:
+                    break
+                self.logger.log(logging.INFO, "Restarting rsync with --bwlimit=%d (was %d)", new_bwlimit, bwlimit)
+                if match:
+                    cmd = self.bwlimit_expr.sub(f"--bwlimit={new_bwlimit}", cmd) if new_bwlimit else self.bwlimit_expr.sub("", cmd)
+                elif new_bwlimit:
+                    cmd = cmd.replace("--info=progress2", f"--info=progress2 --bwlimit={new_bwlimit}", 1)
+        finally:
+            state["running"] = False
+            with self.__lock:
+                self.__active = self.__active - 1
+        return subprocess.CompletedProcess(cmd, process.returncode, b''.join(stdout), b''.join(stderr))
+
+    def __control(self, process: subprocess.Popen, state: dict, bwlimit: int, restartable: bool) -> int:
+        """Watches rsync until it exits
+
+        Returns:
+            int: New --bwlimit if rsync was stopped to restart it with that limit, None once it exited
+        """
+        io_priority = None
+        start_time = time.time()
+        window_start = start_time
+        window_bytes = 0
+        saturated = False
+        factor = 1.0
+        while process.poll() is None:
+            time.sleep(self.interval)
+            now = time.time()
+
+            priority = self.get_io_priority(now)
+            if priority != io_priority:
+                self.logger.log(logging.DEBUG, "I/O priority: %s", priority)
+                self.__set_io_priority(process, priority)
+                io_priority = priority
+
+            limit = self.get_limit(now)
+            latency, state["latency"] = state["latency"], None
+            if limit:
+                with self.__lock:
+                    congestion = False
+                    if latency is not None:
+                        if self.__base_latency is None or latency < self.__base_latency:
+                            self.__base_latency = latency
+                        else:
+                            congestion = latency > self.__base_latency * self.latency_factor + self.latency_margin
+                    if congestion:
+                        self.__factor = max(self.min_limit / limit, self.__factor / 2)
+                        self.logger.log(logging.INFO, "Round trip %dms (lowest %dms). Backing off to %d bytes/s", latency * 1000, self.__base_latency * 1000, int(limit * self.__factor))
+                    elif self.__factor < 1:
+                        self.__factor = min(1.0, self.__factor + self.interval / (self.window * 10))
+
+            elapsed = now - window_start
+            if elapsed > self.window:
+                transferred = state["bytes"] - window_bytes
+                if transferred > 0 and bwlimit:
+                    # Up to the last progress, a stall starting within the window does not lower the rate.
+                    # Progress counts include data matched by the delta algorithm, a rate far above the limit is not the link
+                    rate = transferred / max(self.interval, state["progress_time"] - window_start)
+                    saturated = self.saturation <= rate / (bwlimit * 1024) <= 1 / self.saturation
+                    self.logger.log(logging.DEBUG, "Progress: %d bytes/s Limit: %d bytes/s", int(rate), bwlimit * 1024)
+                window_start = now
+                window_bytes = state["bytes"]
+
+            if now - state["progress_time"] > self.stall_timeout:
+                if saturated and limit:
+                    # Only this transfer backs off, later ones start from the limit of the host
+                    factor = max(self.min_limit / limit, factor / 2)
+                    self.logger.log(logging.INFO, "Transfer stalled at its limit. Backing off to %d bytes/s", int(limit * factor))
+                saturated = False
+                state["progress_time"] = now
+
+            if not restartable or now - start_time < self.restart_interval:
+                continue
+            with self.__lock:
+                active = self.__active
+            share = self.get_share(factor, active, now)
+            if share == bwlimit:
+                continue
+            if not share or not bwlimit or abs(share - bwlimit) > bwlimit * self.restart_margin:
+                self.__stop(process)
+                return share
+        return None
@@ -41,4 +41,23 @@ class NgUtil:
             rmtree(path.as_posix())
             return True
         except Exception:
-            return False
\ No newline at end of file
+            return False
+
+    @staticmethod
+    def parse_size(str_size: str) -> int:
+        """Returns the number of bytes for sizes like 512, 64K, 100M, 2G
+
+        Args:
+            str_size (str): Size with optional K, M, G or T suffix (powers of 1024)
+
+        Returns:
+            int: Size in bytes, None if invalid
+        """
+        multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+        str_size = str_size.strip().upper().rstrip('B')
+        try:
+            if str_size and str_size[-1] in multipliers:
+                return int(float(str_size[:-1]) * multipliers[str_size[-1]])
+            return int(str_size)
+        except ValueError:
+            return None